@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import time
+import threading
+from copy import deepcopy
+
+from ..utils import exceptions, logger
+
+# Block size for matrix requests if the server doesn't report max_matrix_location_pairs, Valhalla's default. Only
+# used to split requests, not to reject them.
+DEFAULT_MATRIX_LOCATION_PAIRS = 2500
+
+DEFAULT_TTL = 3600
+
+_CACHE = dict()
+_CACHE_LOCK = threading.Lock()
+
+
+class Capabilities:
+    """Actions and service limits of a provider."""
+
+    def __init__(self, actions=None, limits=None, version=None):
+        """
+        :param actions: enabled actions, e.g. ['route', 'isochrone'], None if unknown.
+        :type actions: list of str
+
+        :param limits: service limits per service, as reported by the server or configured for the provider.
+            Limits which are unknown aren't enforced, the server rejects requests exceeding them.
+        :type limits: dict
+
+        :param version: Valhalla version of the server, if known.
+        :type version: str
+        """
+        self.actions = set(actions) if actions is not None else None
+        self.version = version
+        self.limits = dict()
+        for service, service_limits in (limits or {}).items():
+            if isinstance(service_limits, dict):
+                self.limits.setdefault(service, dict()).update(deepcopy(service_limits))
+
+    def has_action(self, action):
+        """
+        Whether the server has the action enabled. True if the server didn't tell.
+
+        :param action: action name with or without leading slash, e.g. '/route'
+        :type action: str
+
+        :rtype: bool
+        """
+        return self.actions is None or action.lstrip('/') in self.actions
+
+    def limit(self, service, name, default=None):
+        """
+        Returns a single service limit.
+
+        :param service: costing model or service, e.g. 'auto' or 'isochrone'
+        :type service: str
+
+        :param name: name of the limit, e.g. 'max_locations'
+        :type name: str
+
+        :param default: returned if the limit is unknown.
+        :type default: any
+
+        :rtype: any
+        """
+        return self.limits.get(service, {}).get(name, default)
+
+    def matrix_chunk_size(self, profile):
+        """
+        Returns the largest n, so that an n x n block of sources and targets is within the server's
+        max_matrix_location_pairs.
+
+        :param profile: costing model
+        :type profile: str
+
+        :rtype: int
+        """
+        pairs = self.limit(profile, 'max_matrix_location_pairs', DEFAULT_MATRIX_LOCATION_PAIRS)
+        return max(1, int(pairs ** 0.5))
+
+
+def get_capabilities(clnt, provider):
+    """
+    Returns the capabilities of a provider, discovered with the /status endpoint and cached for the provider's
+    'status_ttl' seconds (default 1 hour). Limits from the provider's 'limits' entry in config.yml take precedence
+    over reported ones. Limits neither reported nor configured are unknown and not enforced on the client.
+
+    :param clnt: client for the provider
+    :type clnt: valhalla.common.client.Client
+
+    :param provider: A provider from config.yml
+    :type provider: dict
+
+    :rtype: Capabilities
+    """
+    key = (provider['base_url'], provider['key'])
+    ttl = provider.get('status_ttl', DEFAULT_TTL)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+    if cached and time.time() - cached[0] < ttl:
+        return cached[1]
+
+    actions, limits, version = None, dict(), None
+    try:
+        response = clnt.request('/status', post_json={'verbose': True, 'id': 'status'})
+        actions = response.get('available_actions')
+        limits = response.get('service_limits') or dict()
+        version = response.get('version')
+    except (exceptions.ApiError,
+            exceptions.InvalidKey,
+            exceptions.GenericServerError,
+            exceptions.Timeout,
+            ValueError) as e:
+        logger.log("Couldn't discover capabilities of {}, only configured limits apply: {}", 1, provider['base_url'], e)
+
+    for service, service_limits in (provider.get('limits') or {}).items():
+        limits.setdefault(service, dict()).update(service_limits)
+
+    capabilities = Capabilities(actions, limits, version)
+    with _CACHE_LOCK:
+        _CACHE[key] = (time.time(), capabilities)
+
+    return capabilities
+
+
+def clear_cache():
+    """Forgets all discovered capabilities, e.g. after the provider settings changed."""
+    with _CACHE_LOCK:
+        _CACHE.clear()
@@ -25,13 +25,15 @@
 """
 
 from datetime import datetime, timedelta
+import gzip
 import requests
 import time
 from urllib.parse import urlencode
 import random
 import json
+import threading
 
-from qgis.PyQt.QtCore import QObject, pyqtSignal, QUrl, QJsonDocument
+from qgis.PyQt.QtCore import QObject, pyqtSignal, QUrl
 from qgis.PyQt.QtNetwork import QNetworkRequest, QNetworkReply
 from qgis.core import QgsNetworkAccessManager, QgsNetworkReplyContent
 
@@ -40,6 +42,45 @@ from ..utils import exceptions, logger
 
 _USER_AGENT = "ValhallaQGISClient@v{}".format(__version__)
 
+# Long-lived clients per thread, see get_client(). They go away with their thread.
+_LOCAL = threading.local()
+
+
+def get_client(provider):
+    """
+    Returns the shared client for a provider, so that keep-alive connections are reused across requests,
+    algorithm runs and GUI clicks. Clients are kept in thread-local storage, because
+    QgsNetworkAccessManager.instance() is thread-local and destroyed with its thread: worker threads never see
+    another (possibly finished) thread's client and their clients are released when they exit.
+
+    Slots connected to overQueryLimit by a previous user of the client are disconnected.
+
+    :param provider: A provider from config.yml
+    :type provider: dict
+
+    :returns: the client for this provider and thread
+    :rtype: Client
+    """
+    key = (
+        provider['base_url'],
+        provider['key'],
+        provider.get('gzip_threshold', 0)
+    )
+    clients = getattr(_LOCAL, 'clients', None)
+    if clients is None:
+        clients = _LOCAL.clients = dict()
+    clnt = clients.get(key)
+    if clnt is None:
+        clnt = clients[key] = Client(provider)
+
+    try:
+        clnt.overQueryLimit.disconnect()
+    except TypeError:
+        # nothing was connected
+        pass
+
+    return clnt
+
 
 class Client(QObject):
     """Performs requests to the ORS API services."""
@@ -48,7 +89,8 @@ class Client(QObject):
                  provider=None,
                  retry_timeout=60):
         """
-        :param provider: A openrouteservice provider from config.yml
+        :param provider: A openrouteservice provider from config.yml. The optional 'gzip_threshold' sets the
+            request body size in bytes above which bodies are sent gzip-compressed, 0 disables it.
         :type provider: dict
 
         :param retry_timeout: Timeout across multiple retriable requests, in
@@ -59,6 +101,7 @@ class Client(QObject):
 
         self.key = provider['key']
         self.base_url = provider['base_url']
+        self.gzip_threshold = provider.get('gzip_threshold', 0)
 
         self.nam = QgsNetworkAccessManager.instance()
         self.nam.setTimeout(60000)
@@ -67,6 +110,8 @@ class Client(QObject):
         self.headers = {
                 "User-Agent": _USER_AGENT,
                 'Content-type': 'application/json',
+                # Setting it explicitly disables Qt's transparent decompression, see _decode_response()
+                'Accept-Encoding': 'gzip',
             }
 
         # Save some references to retrieve in client instances
@@ -75,6 +120,32 @@ class Client(QObject):
         self.response_time = 0
         self.status_code = None
 
+        # Last time a connection to the host was known to be open, see warm_up()
+        self._connected_at = 0
+
+    def warm_up(self, max_age=60):
+        """
+        Opens the (TLS) connection to the provider's host in the background, so the first request doesn't pay
+        for DNS, TCP and TLS setup. Does nothing if a connection was used within the last max_age seconds,
+        since it's most likely still kept alive.
+
+        :param max_age: seconds after which a connection is assumed to be closed by the server.
+        :type max_age: int
+        """
+        if time.time() - self._connected_at < max_age:
+            return
+
+        url = QUrl(self.base_url)
+        if not url.host():
+            return
+        if url.scheme() == 'https':
+            self.nam.connectToHostEncrypted(url.host(), url.port(443))
+        else:
+            self.nam.connectToHost(url.host(), url.port(80))
+
+        self._connected_at = time.time()
+        logger.log("Pre-connecting to {}", 0, url.host())
+
     overQueryLimit = pyqtSignal()
     def request(self, 
                 url,
@@ -123,22 +194,27 @@ class Client(QObject):
                                              )
         url_object = QUrl(self.base_url + authed_url)
         self.url = url_object.url()
-        body = QJsonDocument.fromJson(json.dumps(post_json).encode())
+        body = json.dumps(post_json, separators=(',', ':')).encode()
         request = QNetworkRequest(url_object)
-        request.setHeader(QNetworkRequest.ContentTypeHeader, 'application/json')
-
-        logger.log(
-            "url: {}\nParameters: {}".format(
+        for header, value in self.headers.items():
+            request.setRawHeader(header.encode(), value.encode())
+        if self.gzip_threshold and len(body) > self.gzip_threshold:
+            body = gzip.compress(body, compresslevel=5)
+            request.setRawHeader(b'Content-Encoding', b'gzip')
+
+        # Pretty-printing big request bodies is expensive, only do it if it'd be logged
+        if logger.is_enabled(0):
+            logger.log(
+                "url: {}\nParameters: {}",
+                0,
                 self.url,
-                # final_requests_kwargs
                 json.dumps(post_json, indent=2)
-            ),
-            0
-        )
+            )
 
         start = time.time()
-        response: QgsNetworkReplyContent = self.nam.blockingPost(request, body.toJson())
+        response: QgsNetworkReplyContent = self.nam.blockingPost(request, body)
         self.response_time = time.time() - start
+        self._connected_at = time.time()
 
         try:
             self.handle_response(response, post_json['id'])
@@ -147,13 +223,14 @@ class Client(QObject):
             self.overQueryLimit.emit()
             return self.request(url, first_request_time, retry_counter + 1, post_json)
 
-        response_content = json.loads(bytes(response.content()))
+        response_content = json.loads(self._decode_response(response))
 
         # Mapbox treats 400 errors with a 200 status code
         if 'error' in response_content:
             raise exceptions.ApiError(
                 str(response_content['status_code']),
-                response_content['error']
+                response_content['error'],
+                response_content.get('error_code')
             )
 
         return response_content
@@ -187,25 +264,37 @@ class Client(QObject):
                     error_msg
                 )
             elif self.status_code == 429:
-                logger.log("{}: {}".format(
+                logger.log(
+                    "{}: {}",
+                    1,
                     exceptions.OverQueryLimit.__name__,
                     "Query limit exceeded"
-                ))
+                )
                 raise exceptions.OverQueryLimit(
                     str(429),
                     error_msg
                 )
             # Internal error message for Bad Request
             elif self.status_code and 400 <= self.status_code < 500:
-                logger.log("Feature ID {} caused a {}: {}".format(
+                # Valhalla explains the error in a JSON body
+                valhalla_code = None
+                try:
+                    body = json.loads(self._decode_response(response))
+                    error_msg = body.get('error', error_msg)
+                    valhalla_code = body.get('error_code')
+                except (ValueError, AttributeError, OSError, EOFError):
+                    pass
+                logger.log(
+                    "Feature ID {} caused a {}: {}",
+                    2,
                     feat_id,
                     exceptions.ApiError.__name__,
-                    error_msg,
-                    2
-                ))
+                    error_msg
+                )
                 raise exceptions.ApiError(
                     str(self.status_code),
-                    error_msg
+                    error_msg,
+                    valhalla_code
                 )
             else:
                 raise exceptions.GenericServerError(
@@ -213,6 +302,23 @@ class Client(QObject):
                     error_msg
                 )
 
+    @staticmethod
+    def _decode_response(response):
+        """
+        Returns the raw response body, gunzipped if the server compressed it.
+
+        :param response: The network reply
+        :type response: QgsNetworkReplyContent
+
+        :returns: decompressed response body
+        :rtype: bytes
+        """
+        content = bytes(response.content())
+        if bytes(response.rawHeader(b'Content-Encoding')).strip().lower() == b'gzip':
+            content = gzip.decompress(content)
+
+        return content
+
     def _generate_auth_url(self, path, params):
         """Returns the path and query string portion of the request URL, first
         adding any necessary parameters.
@@ -34,10 +34,10 @@ from qgis.core import (QgsPointXY,
                        QgsFields,
                        QgsField)
 
-from ..utils import convert
+from ..utils import convert, distance
 
 
-def get_request_point_features(route_dict, row_by_row):
+def get_request_point_features(route_dict, row_by_row, max_distance=None):
     """
     Processes input point features depending on the layer to layer relation in directions settings
 
@@ -47,6 +47,10 @@ def get_request_point_features(route_dict, row_by_row):
     :param row_by_row: Specifies whether row-by-row relation or all-by-all has been used.
     :type row_by_row: str
 
+    :param max_distance: If set, pairs further apart (great-circle, in meters) are yielded with None coordinates,
+        so they can be reported without asking the server.
+    :type max_distance: float
+
     :returns: tuple of coordinates and ID field value for each routing feature in route_dict
     :rtype: tuple of QgsPointXY and others
     """
@@ -64,18 +68,32 @@ def get_request_point_features(route_dict, row_by_row):
         values_list = list(zip(route_dict['start']['values'],
                                route_dict['end']['values']))
 
-    for properties in zip(locations_list, values_list):
+    # Great-circle distances in the same order as locations_list
+    distances = None
+    if max_distance and row_by_row == 'Row-by-Row':
+        distances = distance.haversine_pairwise(route_dict['start']['geometries'],
+                                                route_dict['end']['geometries'])
+    elif max_distance:
+        distances = distance.haversine_matrix(route_dict['start']['geometries'],
+                                              route_dict['end']['geometries']).ravel()
+
+    for idx, properties in enumerate(zip(locations_list, values_list)):
         # Skip if first and last location are the same
         if properties[0][0] == properties[0][-1]:
             continue
 
-        coordinates = [QgsPointXY(x, y) for x, y in properties[0]]
         values = properties[1]
+        if distances is not None and distances[idx] > max_distance:
+            yield (None, values)
+            continue
+
+        coordinates = [QgsPointXY(x, y) for x, y in properties[0]]
 
         yield (coordinates, values)
 
 
-def get_fields(from_type=QVariant.String, to_type=QVariant.String, from_name="FROM_ID", to_name="TO_ID", line=False):
+def get_fields(from_type=QVariant.String, to_type=QVariant.String, from_name="FROM_ID", to_name="TO_ID", line=False,
+               fingerprint=False):
     """
     Builds output fields for directions response layer.
 
@@ -94,6 +112,9 @@ def get_fields(from_type=QVariant.String, to_type=QVariant.String, from_name="FR
     :param line: Specifies whether the output feature is a line or a point
     :type line: boolean
 
+    :param fingerprint: add a field for the input fingerprint, see valhalla.utils.fingerprint
+    :type fingerprint: bool
+
     :returns: fields object to set attributes of output layer
     :rtype: QgsFields
     """
@@ -106,11 +127,13 @@ def get_fields(from_type=QVariant.String, to_type=QVariant.String, from_name="FR
     fields.append(QgsField(from_name, from_type))
     if not line:
         fields.append(QgsField(to_name, to_type))
+    if fingerprint:
+        fields.append(QgsField("FINGERPRINT", QVariant.String))
 
     return fields
 
 
-def get_output_feature_directions(response, profile, options=None, from_value=None, to_value=None):
+def get_output_feature_directions(response, profile, options=None, from_value=None, to_value=None, fingerprint=None):
     """
     Build output feature based on response attributes for directions endpoint.
 
@@ -129,6 +152,9 @@ def get_output_feature_directions(response, profile, options=None, from_value=No
     :param to_value: value of 'TO_ID' field
     :type to_value: any
 
+    :param fingerprint: input fingerprint, only set if the fields were built with one
+    :type fingerprint: str
+
     :returns: Ouput feature with attributes and geometry set.
     :rtype: QgsFeature
     """
@@ -145,12 +171,15 @@ def get_output_feature_directions(response, profile, options=None, from_value=No
 
     qgis_coords = [QgsPointXY(x, y) for x, y in coordinates]
     feat.setGeometry(QgsGeometry.fromPolylineXY(qgis_coords))
-    feat.setAttributes([distance,
-                        duration,
-                        profile,
-                        json.dumps(options),
-                        from_value,
-                        to_value
-                        ])
+    attributes = [distance,
+                  duration,
+                  profile,
+                  json.dumps(options),
+                  from_value,
+                  to_value
+                  ]
+    if fingerprint is not None:
+        attributes.append(fingerprint)
+    feat.setAttributes(attributes)
 
     return feat
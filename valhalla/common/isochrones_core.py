@@ -25,7 +25,9 @@
 """
 
 import json
+import struct
 
+import numpy as np
 from PyQt5.QtCore import QVariant
 from PyQt5.QtGui import QColor
 
@@ -35,11 +37,102 @@ from qgis.core import (QgsPointXY,
                        QgsField,
                        QgsFields,
                        QgsGeometry,
+                       QgsWkbTypes,
                        QgsSymbol,
                        QgsSimpleFillSymbolLayer,
                        QgsRendererCategory,
                        QgsCategorizedSymbolRenderer)
 
+GEOMETRY_TYPES = ('LineString', 'Polygon', 'MultiPolygon')
+
+
+def _coords_wkb(coords):
+    """Point count and little endian x/y doubles of a GeoJSON coordinate list."""
+    if not coords:
+        return struct.pack('<I', 0)
+    array = np.array(coords, dtype='<f8').reshape(len(coords), -1)[:, :2]
+
+    return struct.pack('<I', len(array)) + np.ascontiguousarray(array).tobytes()
+
+
+def _polygon_wkb(rings):
+    return struct.pack('<BII', 1, 3, len(rings)) + b''.join(_coords_wkb(ring) for ring in rings)
+
+
+def get_wkb(geometry):
+    """
+    Encodes a GeoJSON LineString, Polygon or MultiPolygon as WKB, converting each ring in one go instead of
+    creating a Python object per vertex.
+
+    :param geometry: GeoJSON geometry
+    :type geometry: dict
+
+    :rtype: bytes
+    """
+    geom_type = geometry['type']
+    coordinates = geometry['coordinates']
+    # Byte order flag 1 (little endian) and WKB type 2/3/6 (LineString/Polygon/MultiPolygon) head each geometry
+    if geom_type == 'LineString':
+        return struct.pack('<BI', 1, 2) + _coords_wkb(coordinates)
+    if geom_type == 'Polygon':
+        return _polygon_wkb(coordinates)
+    if geom_type == 'MultiPolygon':
+        return struct.pack('<BII', 1, 6, len(coordinates)) + b''.join(_polygon_wkb(poly) for poly in coordinates)
+
+    raise ValueError(f"Unsupported isochrone geometry type {geom_type}")
+
+
+def get_geometry(geometry):
+    """
+    Converts a GeoJSON isochrone geometry to a QgsGeometry.
+
+    :param geometry: GeoJSON LineString, Polygon or MultiPolygon
+    :type geometry: dict
+
+    :rtype: QgsGeometry
+    """
+    geom = QgsGeometry()
+    geom.fromWkb(get_wkb(geometry))
+
+    return geom
+
+
+def get_geometries(geometries):
+    """
+    Converts the GeoJSON isochrone geometries of a response, encoding every geometry as WKB with get_geometry().
+
+    :param geometries: GeoJSON LineStrings, Polygons or MultiPolygons
+    :type geometries: list of dict
+
+    :returns: geometries in the same order
+    :rtype: list of QgsGeometry
+    """
+    return [get_geometry(geometry) for geometry in geometries]
+
+
+def get_bands(geometries):
+    """
+    Turns nested contour polygons into non-overlapping bands by removing the next smaller contour from each one.
+
+    :param geometries: contour polygons, largest first
+    :type geometries: list of QgsGeometry
+
+    :returns: bands in the same order, the smallest contour stays as it is
+    :rtype: list of QgsGeometry
+    """
+    bands = []
+    for larger, smaller in zip(geometries, geometries[1:]):
+        if larger.type() != QgsWkbTypes.PolygonGeometry or smaller.isEmpty():
+            bands.append(larger)
+            continue
+        band = larger.difference(smaller)
+        # Keep the full contour if GEOS fails on it
+        bands.append(band if not band.isNull() else larger)
+    bands.extend(geometries[len(bands):])
+
+    return bands
+
+
 class Isochrones():
     """convenience class to build isochrones"""
 
@@ -52,6 +145,7 @@ class Isochrones():
         self.id_field_type = None
         self.id_field_name = None
         self.response = None
+        self.options_json = json.dumps({})
 
     def set_parameters(self, profile, geometry_param='Polygon', id_field_type=QVariant.String, id_field_name='ID'):
         """
@@ -83,10 +177,22 @@ class Isochrones():
         """
         self.response = response
 
-    def get_fields(self):
+    def set_options(self, options):
+        """
+        Sets the costing options written to every feature, so they're only serialized once per run.
+
+        :param options: costing options
+        :type options: dict
+        """
+        self.options_json = json.dumps(options)
+
+    def get_fields(self, fingerprint=False):
         """
         Set all fields for output isochrone layer.
 
+        :param fingerprint: add a field for the input fingerprint, see valhalla.utils.fingerprint
+        :type fingerprint: bool
+
         :returns: Fields object of all output fields.
         :rtype: QgsFields
         """
@@ -96,6 +202,8 @@ class Isochrones():
         fields.append(QgsField("profile", QVariant.String))
         fields.append(QgsField('options', QVariant.String))
         fields.append(QgsField('metric', QVariant.String))
+        if fingerprint:
+            fields.append(QgsField('fingerprint', QVariant.String))
 
         return fields
 
@@ -112,58 +220,59 @@ class Isochrones():
 
         return fields
 
-    def get_features(self, id_field_value, options={}):
+    def get_features(self, id_field_value, options=None, metric='time', fingerprint=None, bands=False):
         """
         Generator to return output isochrone features from response.
 
         :param id_field_value: Value of ID field.
         :type id_field_value: any
 
-        :param options: costing options
+        :param options: costing options, the ones from set_options() if None
         :type options: dict
 
+        :param metric: contour metric of the response, 'time' or 'distance'
+        :type metric: str
+
+        :param fingerprint: input fingerprint, only set if the fields were built with one
+        :type fingerprint: str
+
+        :param bands: return non-overlapping bands between consecutive contours instead of nested polygons, as
+            MultiPolygons
+        :type bands: bool
+
         :returns: output feature
         :rtype: QgsFeature
         """
 
-        features = [feature for feature in self.response['features'] if feature['geometry']['type'] in ('LineString', 'Polygon', 'MultiPolygon')]
+        options_json = self.options_json if options is None else json.dumps(options)
+        features = [feature for feature in self.response['features'] if feature['geometry']['type'] in GEOMETRY_TYPES]
         # Sort features based on the isochrone value, so that longest isochrone
         # is added first. This will plot the isochrones on top of each other.
-        l = lambda x: x['properties']['contour']
-        for isochrone in sorted(features, key=l, reverse=True):
+        # Valhalla usually sends them in that order already.
+        contours = [feature['properties']['contour'] for feature in features]
+        if any(a < b for a, b in zip(contours, contours[1:])):
+            features.sort(key=lambda x: x['properties']['contour'], reverse=True)
+
+        geometries = get_geometries([isochrone['geometry'] for isochrone in features])
+        if bands:
+            geometries = get_bands(geometries)
+            # Bands go to MultiPolygon layers, since differences can have several parts
+            for geometry in geometries:
+                geometry.convertToMultiType()
+        for isochrone, geometry in zip(features, geometries):
             feat = QgsFeature()
-            coordinates = isochrone['geometry']['coordinates']
-            geom_type = isochrone['geometry']['type']
-            iso_value = isochrone['properties']['contour']
-            qgis_coords = []
-            if geom_type == 'Polygon':
-                for ring in coordinates:
-                    ring_coords = []
-                    for coord in ring:
-                        ring_coords.append(QgsPointXY(coord[0], coord[1]))
-                    qgis_coords.append(ring_coords)
-                feat.setGeometry(QgsGeometry.fromPolygonXY(qgis_coords))
-            if geom_type == 'LineString':
-                qgis_coords = [QgsPointXY(coord[0], coord[1]) for coord in coordinates]
-                feat.setGeometry(QgsGeometry.fromPolylineXY(qgis_coords))
-            if geom_type == 'MultiPolygon':
-                for poly in coordinates:
-                    poly_coords = []
-                    for ring in poly:
-                        ring_coords = []
-                        for coord in ring:
-                            ring_coords.append(QgsPointXY(coord[0], coord[1]))
-                        poly_coords.append(ring_coords)
-                    qgis_coords.append(poly_coords)
-                feat.setGeometry(QgsGeometry.fromMultiPolygonXY(qgis_coords))
+            feat.setGeometry(geometry)
 
-            feat.setAttributes([
+            attributes = [
                 id_field_value,
-                float(iso_value),
+                float(isochrone['properties']['contour']),
                 self.profile,
-                json.dumps(options),
-                'time'
-            ])
+                options_json,
+                metric
+            ]
+            if fingerprint is not None:
+                attributes.append(fingerprint)
+            feat.setAttributes(attributes)
 
             yield feat
 
@@ -189,16 +298,27 @@ class Isochrones():
 
             yield feat
 
-    def get_point_features(self, id_field_value):
+    def get_point_features(self, id_field_value, location=None):
         """
         Generator to return isochrone input locations from response.
 
         :param id_field_value: Value of ID field.
         :type id_field_value: any
 
+        :param location: input location to return instead of the response's, e.g. if the response was requested
+            for another origin.
+        :type location: QgsPointXY
+
         :returns: output feature
         :rtype: QgsFeature
         """
+        if location is not None:
+            feat = QgsFeature()
+            feat.setGeometry(QgsGeometry.fromPointXY(location))
+            feat.setAttributes([id_field_value, 'input'])
+            yield feat
+            return
+
         points = [feature for feature in self.response['features'] if feature['geometry']['type'] == 'Point']
         for point in points:
             feat = QgsFeature()
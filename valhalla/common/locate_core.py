@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from PyQt5.QtCore import QVariant
+
+from qgis.core import (QgsFeature,
+                       QgsFields,
+                       QgsField,
+                       QgsPointXY,
+                       QgsGeometry)
+
+from ..utils import distance, exceptions, logger
+
+
+def get_fields(id_type=QVariant.String, id_name="ID"):
+    """
+    Builds output fields for the snapped points layer.
+
+    :param id_type: field type for the ID field
+    :type id_type: QVariant enum
+
+    :param id_name: field name for the ID field
+    :type id_name: str
+
+    :returns: fields object to set attributes of output layer
+    :rtype: QgsFields
+    """
+    fields = QgsFields()
+    fields.append(QgsField(id_name, id_type))
+    fields.append(QgsField("EDGE_ID", QVariant.LongLong))
+    fields.append(QgsField("WAY_ID", QVariant.LongLong))
+    fields.append(QgsField("PERCENT_ALONG", QVariant.Double))
+    fields.append(QgsField("SIDE_OF_STREET", QVariant.String))
+    fields.append(QgsField("SNAP_DIST_M", QVariant.Double))
+    fields.append(QgsField("EDGE_COUNT", QVariant.Int))
+
+    return fields
+
+
+def get_snapped_location(result):
+    """
+    Returns the closest edge candidate of one /locate result.
+
+    :param result: /locate result of a single location
+    :type result: dict
+
+    :returns: the closest edge or None if the location couldn't be snapped.
+    :rtype: dict
+    """
+    edges = (result or {}).get('edges') or []
+
+    return edges[0] if edges else None
+
+
+def _location_key(point):
+    return round(point.x(), 6), round(point.y(), 6)
+
+
+def snap_locations(clnt, points, profile, costing_params=None, batch_size=20):
+    """
+    Resolves every unique location once with /locate, so later requests can use the snapped coordinates instead
+    of having the server correlate the same location again and again.
+
+    :param clnt: client to request /locate with
+    :type clnt: valhalla.common.client.Client
+
+    :param points: WGS84 locations, duplicates are snapped once
+    :type points: list of QgsPointXY
+
+    :param profile: transportation profile
+    :type profile: str
+
+    :param costing_params: profile specific costing options
+    :type costing_params: dict
+
+    :param batch_size: locations per request, the provider's max_locations
+    :type batch_size: int
+
+    :returns: snapped locations by rounded input coordinates, locations which couldn't be snapped are left out.
+    :rtype: dict
+    """
+    unique = list(dict.fromkeys(_location_key(point) for point in points))
+    snapped = dict()
+    for i in range(0, len(unique), batch_size):
+        chunk = unique[i:i + batch_size]
+        params = {
+            'costing': profile,
+            'verbose': False,
+            'id': i,
+            'locations': [{'lon': lon, 'lat': lat} for lon, lat in chunk]
+        }
+        if costing_params:
+            params['costing_options'] = costing_params
+        try:
+            response = clnt.request('/locate', post_json=params)
+        except exceptions.ApiError as e:
+            # The requests will correlate these locations themselves
+            logger.log(f"Pre-snapping {len(chunk)} locations failed: {e}", 1)
+            continue
+
+        for key, result in zip(chunk, response):
+            edge = get_snapped_location(result)
+            if edge is not None:
+                snapped[key] = QgsPointXY(edge['correlated_lon'], edge['correlated_lat'])
+
+    return snapped
+
+
+def apply_snapped(points, snapped):
+    """
+    Replaces locations by their snapped coordinates from snap_locations().
+
+    :param points: WGS84 locations
+    :type points: list of QgsPointXY
+
+    :param snapped: snapped locations by rounded input coordinates
+    :type snapped: dict
+
+    :returns: snapped locations, unsnapped ones unchanged
+    :rtype: list of QgsPointXY
+    """
+    return [snapped.get(_location_key(point), point) for point in points]
+
+
+def get_output_features(response, id_values, points):
+    """
+    Generator to return one snapped point feature per input location, with the attributes of the closest edge.
+    Locations which couldn't be snapped get no geometry and NULL attributes.
+
+    :param response: /locate response, one result per location
+    :type response: list of dict
+
+    :param id_values: ID field values of the locations
+    :type id_values: list
+
+    :param points: WGS84 input locations
+    :type points: list of QgsPointXY
+
+    :returns: output feature
+    :rtype: QgsFeature
+    """
+    for id_value, point, result in zip(id_values, points, response):
+        feat = QgsFeature()
+        edge = get_snapped_location(result)
+        if edge is None:
+            feat.setAttributes([id_value, None, None, None, None, None, 0])
+            yield feat
+            continue
+
+        snapped = QgsPointXY(edge['correlated_lon'], edge['correlated_lat'])
+        feat.setGeometry(QgsGeometry.fromPointXY(snapped))
+        edge_info = edge.get('edge_info') or {}
+        feat.setAttributes([
+            id_value,
+            (edge.get('edge_id') or {}).get('value'),
+            edge_info.get('way_id', edge.get('way_id')),
+            edge.get('percent_along'),
+            edge.get('side_of_street'),
+            round(float(distance.haversine_pairwise([point], [snapped])[0]), 2),
+            len(result['edges'])
+        ])
+
+        yield feat
@@ -24,7 +24,10 @@
  ***************************************************************************/
 """
 
+import csv
 import json
+import os.path
+import numpy as np
 from PyQt5.QtCore import QVariant
 
 from qgis.core import (QgsFeature,
@@ -35,6 +38,8 @@ from qgis.core import (QgsFeature,
 
 from valhalla.utils import convert, logger
 
+# Two columns per target plus the source ID column have to fit GeoPackage's 2000 column limit
+MAX_WIDE_TARGETS = 999
 
 def get_fields(from_type=QVariant.String, to_type=QVariant.String, from_name="FROM_ID", to_name="TO_ID"):
     """
@@ -67,6 +72,66 @@ def get_fields(from_type=QVariant.String, to_type=QVariant.String, from_name="FR
     return fields
 
 
+def get_wide_fields(from_type, target_ids, from_name="FROM_ID"):
+    """
+    Builds output fields for the wide matrix layer: one row per source with a duration and a distance column per
+    target, named after the target's ID value.
+
+    :param from_type: field type for 'FROM_ID' field
+    :type from_type: QVariant enum
+
+    :param target_ids: ID field values of the targets, in input order.
+    :type target_ids: list of any
+
+    :param from_name: field name for 'FROM_ID' field
+    :type from_name: str
+
+    :returns: fields object to set attributes of output layer
+    :rtype: QgsFields
+    """
+    fields = QgsFields()
+    fields.append(QgsField(from_name, from_type))
+
+    suffixes = set()
+    for idx, target_id in enumerate(target_ids):
+        suffix = str(target_id)
+        # Keep field names unique for duplicate IDs, also against IDs which look like a deduplicated one
+        while suffix in suffixes:
+            suffix = "{}_{}".format(suffix, idx)
+        suffixes.add(suffix)
+        fields.append(QgsField("DURATION_H_" + suffix, QVariant.Double))
+        fields.append(QgsField("DIST_KM_" + suffix, QVariant.Double))
+
+    return fields
+
+
+def get_output_features_wide(store):
+    """
+    Generator to return one output feature per source from a filled matrix store, with attributes in the order
+    of get_wide_fields().
+
+    :param store: results of the whole matrix
+    :type store: MatrixStore
+
+    :returns: output feature
+    :rtype: QgsFeature
+    """
+    for row, from_id in enumerate(store.source_ids):
+        durations = np.round(store.durations[row].astype(np.float64) / 3600, 3).tolist()
+        distances = np.round(store.distances[row].astype(np.float64), 3).tolist()
+
+        attributes = [from_id]
+        for duration, dist in zip(durations, distances):
+            # NaN marks NULL results
+            attributes.append(None if duration != duration else duration)
+            attributes.append(None if dist != dist else dist)
+
+        feat = QgsFeature()
+        feat.setAttributes(attributes)
+
+        yield feat
+
+
 def get_output_features_matrix(response, profile, options={}, matrix_geometries=False, source_attrs=[], destination_attrs=[]):
     """
     Build output feature based on response attributes for directions endpoint.
@@ -131,3 +196,174 @@ def get_output_features_matrix(response, profile, options={}, matrix_geometries=
             feats.append(feat)
 
     return feats
+
+
+def get_null_feature_matrix(from_id, to_id, profile, options={}):
+    """
+    Build output feature for a source/target pair which wasn't requested, e.g. because it's beyond the server's
+    limits. Distance and duration are NULL, same as for unroutable pairs.
+
+    :param from_id: Attribute value of the source feature.
+    :type from_id: any
+
+    :param to_id: Attribute value of the destination feature.
+    :type to_id: any
+
+    :param profile: Transportation mode being used
+    :type profile: str
+
+    :param options: Costing options being used.
+    :type options: dict
+
+    :returns: Output feature with attributes set.
+    :rtype: QgsFeature
+    """
+    feat = QgsFeature()
+    feat.setAttributes([
+        from_id,
+        to_id,
+        None,
+        None,
+        profile,
+        json.dumps(options),
+    ])
+
+    return feat
+
+
+def split_matrix_block(valid):
+    """
+    Splits a block of sources and targets into sub-blocks which only contain valid pairs. Rows or columns with
+    the most invalid pairs are greedily taken out of the block, the remaining block is requested as a whole and
+    every removed source or target is requested with its valid counterparts on its own.
+
+    :param valid: sources x targets array, True where the pair can be requested.
+    :type valid: numpy.ndarray of bool
+
+    :returns: sub-blocks as (source indices, target indices) and the invalid (source index, target index) pairs.
+    :rtype: tuple of list
+    """
+    valid = np.asarray(valid, dtype=bool)
+    n_sources, n_targets = valid.shape
+    invalid_pairs = [(int(s), int(t)) for s, t in zip(*np.nonzero(~valid))]
+    if not invalid_pairs:
+        return [(list(range(n_sources)), list(range(n_targets)))], invalid_pairs
+
+    keep_sources = np.ones(n_sources, dtype=bool)
+    keep_targets = np.ones(n_targets, dtype=bool)
+    while True:
+        invalid = ~valid & keep_sources[:, None] & keep_targets[None, :]
+        if not invalid.any():
+            break
+        source_counts = invalid.sum(axis=1)
+        target_counts = invalid.sum(axis=0)
+        if source_counts.max() >= target_counts.max():
+            keep_sources[source_counts.argmax()] = False
+        else:
+            keep_targets[target_counts.argmax()] = False
+
+    blocks = []
+    kept_sources = np.nonzero(keep_sources)[0].tolist()
+    kept_targets = np.nonzero(keep_targets)[0].tolist()
+    if kept_sources and kept_targets:
+        blocks.append((kept_sources, kept_targets))
+    # Removed sources against all their valid targets
+    for s in np.nonzero(~keep_sources)[0]:
+        targets = np.nonzero(valid[s])[0].tolist()
+        if targets:
+            blocks.append(([int(s)], targets))
+    # Removed targets against their valid, kept sources; removed sources were handled above
+    for t in np.nonzero(~keep_targets)[0]:
+        sources = np.nonzero(valid[:, t] & keep_sources)[0].tolist()
+        if sources:
+            blocks.append((sources, [int(t)]))
+
+    return blocks, invalid_pairs
+
+
+class MatrixStore:
+    """
+    Columnar store for matrix results: durations and distances are written into preallocated float32 arrays
+    indexed by source and target order, instead of building one feature per cell. Cells which weren't requested
+    or aren't routable stay NaN.
+    """
+
+    def __init__(self, source_ids, target_ids, path, memmap=False):
+        """
+        :param source_ids: ID field values of the sources, in input order.
+        :type source_ids: list of any
+
+        :param target_ids: ID field values of the targets, in input order.
+        :type target_ids: list of any
+
+        :param path: output .npz path. Its base name is used for the ID index and memory-mapped .npy files.
+            None to only hold the results in memory.
+        :type path: str
+
+        :param memmap: Back the arrays by .npy files on disk instead of memory. Needs a path.
+        :type memmap: bool
+        """
+        self.source_ids = source_ids
+        self.target_ids = target_ids
+        self.base_path = os.path.splitext(path)[0] if path else None
+        self.memmap = memmap and bool(path)
+
+        shape = (len(source_ids), len(target_ids))
+        if self.memmap:
+            self.durations = np.lib.format.open_memmap(
+                self.base_path + '_durations.npy', mode='w+', dtype=np.float32, shape=shape
+            )
+            self.distances = np.lib.format.open_memmap(
+                self.base_path + '_distances.npy', mode='w+', dtype=np.float32, shape=shape
+            )
+            self.durations[:] = np.nan
+            self.distances[:] = np.nan
+        else:
+            self.durations = np.full(shape, np.nan, dtype=np.float32)
+            self.distances = np.full(shape, np.nan, dtype=np.float32)
+
+    def add_response(self, response, sources, targets):
+        """
+        Writes a /sources_to_targets response into the arrays.
+
+        :param response: API response object
+        :type response: dict
+
+        :param sources: indices of the requested sources, in request order.
+        :type sources: list of int
+
+        :param targets: indices of the requested targets, in request order.
+        :type targets: list of int
+        """
+        rows = response['sources_to_targets']
+        cells = np.ix_(sources, targets)
+        self.durations[cells] = [[np.nan if c['time'] is None else c['time'] for c in row] for row in rows]
+        self.distances[cells] = [[np.nan if c['distance'] is None else c['distance'] for c in row] for row in rows]
+
+    def save(self):
+        """
+        Writes the arrays, as .npz archive with 'durations' [s] and 'distances' [km] unless they're already
+        memory-mapped .npy files, and the ID index as CSV with type ('source'/'target'), index and id.
+
+        :returns: paths of all written files
+        :rtype: list of str
+        """
+        paths = []
+        if self.memmap:
+            self.durations.flush()
+            self.distances.flush()
+            paths.extend([self.base_path + '_durations.npy', self.base_path + '_distances.npy'])
+        else:
+            np.savez(self.base_path + '.npz', durations=self.durations, distances=self.distances)
+            paths.append(self.base_path + '.npz')
+
+        ids_path = self.base_path + '_ids.csv'
+        with open(ids_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['type', 'index', 'id'])
+            for kind, ids in (('source', self.source_ids), ('target', self.target_ids)):
+                for idx, value in enumerate(ids):
+                    writer.writerow([kind, idx, value])
+        paths.append(ids_path)
+
+        return paths
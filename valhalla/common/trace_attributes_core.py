@@ -23,8 +23,10 @@
  *                                                                         *
  ***************************************************************************/
 """
+import struct
 from typing import Tuple, List
 
+import numpy as np
 from PyQt5.QtCore import QVariant
 from qgis._core import QgsPointXY, QgsGeometry
 from qgis.core import QgsFields, QgsField, QgsFeature
@@ -32,16 +34,71 @@ from qgis.core import QgsFields, QgsField, QgsFeature
 from ..utils.convert import decode_polyline6
 
 
-def get_fields(t: str) -> QgsFields:
+# Response attributes read by get_output_features()
+FILTER_ATTRIBUTES = [
+    'shape',
+    'edge.id',
+    'edge.way_id',
+    'edge.speed',
+    'edge.length',
+    'edge.mean_elevation',
+    'edge.source_along_edge',
+    'edge.target_along_edge',
+    'edge.begin_shape_index',
+    'edge.end_shape_index',
+    'matched.point',
+    'matched.type',
+    'matched.edge_index',
+    'matched.distance_along_edge',
+    'matched.distance_from_trace_point',
+]
+
+# Optional edge attributes and their field types
+EXTRA_EDGE_ATTRIBUTES = {
+    'names': QVariant.String,
+    'road_class': QVariant.String,
+    'use': QVariant.String,
+    'surface': QVariant.String,
+    'speed_limit': QVariant.Int,
+    'lane_count': QVariant.Int,
+    'weighted_grade': QVariant.Double,
+    'begin_heading': QVariant.Int,
+    'end_heading': QVariant.Int,
+    'traversability': QVariant.String,
+    'toll': QVariant.Bool,
+    'tunnel': QVariant.Bool,
+    'bridge': QVariant.Bool,
+    'density': QVariant.Int,
+}
+
+
+def get_filters(extra_attributes: List[str] = ()) -> dict:
+    """
+    Returns the trace_attributes filters to only include the attributes which are output.
+
+    :param extra_attributes: names of optional edge attributes, see EXTRA_EDGE_ATTRIBUTES
+    :returns: filters parameter
+    """
+    return {
+        'attributes': FILTER_ATTRIBUTES + ['edge.' + name for name in extra_attributes],
+        'action': 'include'
+    }
+
+
+def get_fields(t: str, id_field: QgsField = None, extra_attributes: List[str] = ()) -> QgsFields:
     """
     Returns the fields for trace_attributes depending on type of layer.
 
     :param t: edge or point
+    :param id_field: optional track ID field, prepended to the other fields
+    :param extra_attributes: names of optional edge attributes, appended to the edge fields
     :returns: initialized QgsFields object
     """
 
 
     fields = QgsFields()
+    if id_field is not None:
+        fields.append(id_field)
     if t == 'edge':
         fields.append(QgsField("EDGE_ID", QVariant.Double))
         fields.append(QgsField("OSM_ID", QVariant.Double))
@@ -50,6 +107,8 @@ def get_fields(t: str) -> QgsFields:
         fields.append(QgsField("MEAN_ELEVATION", QVariant.Int))
         fields.append(QgsField("SRC_PERC", QVariant.Double))
         fields.append(QgsField("TARGET_PERC", QVariant.Double))
+        for name in extra_attributes:
+            fields.append(QgsField(name.upper(), EXTRA_EDGE_ATTRIBUTES[name]))
     else:
         fields.append(QgsField("TYPE", QVariant.String))
         fields.append(QgsField("EDGE_INDEX", QVariant.Double))
@@ -59,18 +118,159 @@ def get_fields(t: str) -> QgsFields:
     return fields
 
 
-def get_output_features(response: dict) -> Tuple[List[QgsFeature], List[QgsFeature]]:
+def get_shape_array(shape: str) -> np.ndarray:
+    """
+    Decodes an encoded polyline6 shape once into a contiguous array.
+
+    :param shape: encoded polyline6
+    :returns: (n, 2) array of lon, lat
+    """
+    coords = np.array(decode_polyline6(shape), dtype=np.float64).reshape(-1, 2)
+
+    return np.ascontiguousarray(coords[:, ::-1])
+
+
+def get_line_geometry(coords: np.ndarray) -> QgsGeometry:
+    """
+    Builds a line geometry from a view into the shape array, via WKB so no per-vertex Python objects are created.
+
+    :param coords: (n, 2) array of lon, lat
+    :returns: LineString geometry
+    """
+    geom = QgsGeometry()
+    geom.fromWkb(struct.pack('<BII', 1, 2, len(coords)) + coords.tobytes())
+
+    return geom
+
+
+def get_windows(n_points: int, window_size: int, overlap: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Splits a trace into overlapping windows which can be matched independently. Every point is owned by exactly
+    one window, the overlap is split in half between neighbouring windows.
+
+    :param n_points: number of trace points
+    :param window_size: maximum number of points per window
+    :param overlap: number of points shared by neighbouring windows, smaller than window_size
+    :returns: start and end (exclusive) trace index of each window and the window-local range of owned points
+    """
+    if n_points <= window_size:
+        return [(0, n_points, 0, n_points)]
+
+    bounds = []
+    start = 0
+    while True:
+        end = min(start + window_size, n_points)
+        bounds.append((start, end))
+        if end == n_points:
+            break
+        start += window_size - overlap
+
+    windows = []
+    for idx, (start, end) in enumerate(bounds):
+        owned_start = overlap // 2 if idx > 0 else 0
+        owned_end = end - start - (overlap - overlap // 2) if idx < len(bounds) - 1 else end - start
+        windows.append((start, end, owned_start, owned_end))
+
+    return windows
+
+
+def stitch_responses(windows: List[Tuple[dict, int, int]]) -> Tuple[dict, np.ndarray]:
+    """
+    Stitches the responses of consecutive windows into one continuous edge sequence. Each window contributes the
+    edges from its first owned point up to the next window's first owned edge, an edge repeated at the start of a
+    window is de-duplicated.
+
+    :param windows: response and window-local range of owned points of each window, in trace order
+    :returns: stitched response with 'edges' and 'matched_points' indexing into the returned shape array
+    """
+    shapes, edges, points = [], [], []
+    n_shape = 0
+
+    # Window-local range of edges the owned points are matched to
+    ranges = []
+    for response, owned_start, owned_end in windows:
+        window_edges = response['edges']
+        # Unmatched points have no (or an invalid) edge_index
+        edge_indices = [point['edge_index'] for point in response['matched_points'][owned_start:owned_end]
+                        if point.get('edge_index') is not None and point['edge_index'] < len(window_edges)]
+        ranges.append((min(edge_indices), max(edge_indices)) if edge_indices else None)
+
+    for idx, (response, owned_start, owned_end) in enumerate(windows):
+        window_edges = response['edges']
+        window_points = response['matched_points'][owned_start:owned_end]
+
+        # Window-local to stitched edge index
+        edge_map = {}
+        if ranges[idx] is not None:
+            first, last = ranges[idx]
+            # Edges between the last owned point and the next window's first owned point are only in this window's
+            # overlap: extend up to the next window's first edge, which that window then de-duplicates.
+            following = next(((j, r) for j, r in enumerate(ranges) if j > idx and r is not None), None)
+            if following is not None:
+                next_idx, (next_first, _) = following
+                next_id = windows[next_idx][0]['edges'][next_first]['id']
+                for edge_idx in range(last, len(window_edges)):
+                    if window_edges[edge_idx]['id'] == next_id:
+                        last = edge_idx
+                        break
+
+            if edges and window_edges[first]['id'] == edges[-1]['id']:
+                edge_map[first] = len(edges) - 1
+                first += 1
+
+            if first <= last:
+                shape_pts = get_shape_array(response['shape'])
+                begin = window_edges[first]['begin_shape_index']
+                end = window_edges[last]['end_shape_index']
+                shapes.append(shape_pts[begin:end + 1])
+                for edge_idx in range(first, last + 1):
+                    edge = dict(window_edges[edge_idx])
+                    edge['begin_shape_index'] += n_shape - begin
+                    edge['end_shape_index'] += n_shape - begin
+                    edge_map[edge_idx] = len(edges)
+                    edges.append(edge)
+                n_shape += end - begin + 1
+
+        for point in window_points:
+            point = dict(point)
+            if point.get('edge_index') in edge_map:
+                point['edge_index'] = edge_map[point['edge_index']]
+            else:
+                point.pop('edge_index', None)
+            points.append(point)
+
+    shape_pts = np.concatenate(shapes) if shapes else np.empty((0, 2))
+
+    return {'edges': edges, 'matched_points': points}, shape_pts
+
+
+def _get_edge_value(edge: dict, name: str):
+    value = edge.get(name)
+    if isinstance(value, list):
+        return ', '.join(map(str, value))
+
+    return value
+
+
+def get_output_features(response: dict,
+                        shape_pts: np.ndarray = None,
+                        extra_attributes: List[str] = ()) -> Tuple[List[QgsFeature], List[QgsFeature]]:
     """
     Returns the line & point features
+
+    :param response: trace_attributes response or stitched response
+    :param shape_pts: decoded shape, decoded from response['shape'] if None
+    :param extra_attributes: names of optional edge attributes, in the order of get_fields()
     """
     edge_feats, point_feats = [], []
 
-    shape_pts = [list(reversed(coord)) for coord in decode_polyline6(response['shape'])]
+    if shape_pts is None:
+        shape_pts = get_shape_array(response['shape'])
 
     for edge in response['edges']:
         feat = QgsFeature()
-        coords = [QgsPointXY(x, y) for x, y in shape_pts[edge['begin_shape_index'] : edge['end_shape_index'] + 1]]
-        feat.setGeometry(QgsGeometry.fromPolylineXY(coords))
+        # Edges share their end vertex with the next edge, slicing only creates views
+        feat.setGeometry(get_line_geometry(shape_pts[edge['begin_shape_index']:edge['end_shape_index'] + 1]))
         feat.setAttributes([
             edge['id'],
             edge['way_id'],
@@ -78,7 +278,8 @@ def get_output_features(response: dict) -> Tuple[List[QgsFeature], List[QgsFeatu
             edge['length'],
             edge.get('mean_elevation'),
             edge.get('source_percent_along'),
-            edge.get('target_percent_along')
+            edge.get('target_percent_along'),
+            *[_get_edge_value(edge, name) for name in extra_attributes]
         ])
         edge_feats.append(feat)
 
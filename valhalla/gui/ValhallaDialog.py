@@ -180,6 +180,7 @@ class ValhallaDialogMain:
         self.iface.webMenu().removeAction(self.menu.menuAction())
         self.iface.removeWebToolBarIcon(self.actions[0])
         QApplication.restoreOverrideCursor()
+        logger.flush()
         del self.dlg
 
     def _cleanup_annotations(self):
@@ -213,6 +214,7 @@ class ValhallaDialogMain:
         # Populate provider box on window startup, since can be changed from multiple menus/buttons
 
         self.dlg.show()
+        self.dlg.warm_up_provider()
 
     def run_gui_control(self):
         """Slot function for OK button of main dialog."""
@@ -258,7 +260,7 @@ class ValhallaDialogMain:
             )
             return
 
-        clnt = client.Client(provider)
+        clnt = client.get_client(provider)
         clnt_msg = ''
 
         method = self.dlg.routing_method.currentText()
@@ -336,10 +338,11 @@ class ValhallaDialogMain:
                     layer_out.dataProvider().addAttributes(isochrones.get_fields())
                     layer_out.updateFields()
 
+                    isochrones.set_options(isochrones_ui.costing_options)
                     for i, location in enumerate(locations):
                         params['locations'] = location if aggregate else [location]
                         isochrones.set_response(clnt.request('/isochrone', {}, post_json=params))
-                        for feat in isochrones.get_features(str(i), isochrones_ui.costing_options):
+                        for feat in isochrones.get_features(str(i), metric=metric):
                             layer_out.dataProvider().addFeature(feat)
 
                     layer_out.updateExtents()
@@ -513,6 +516,7 @@ class ValhallaDialogMain:
             # Set URL in debug window
             clnt_msg += '<a href="{0}">{0}</a><br>Parameters:<br>{1}<br><b>timing</b>: {2:.3f} secs'.format(clnt.url, json.dumps(params, indent=2), clnt.response_time)
             self.dlg.debug_text.setHtml(clnt_msg)
+            logger.flush()
 
     def _display_error_popup(self, e):
         QMessageBox.critical(
@@ -559,6 +563,7 @@ class ValhallaDialog(QDialog, Ui_ValhallaDialogBase):
         self.help_button.clicked.connect(on_help_click)
         self.about_button.clicked.connect(lambda: on_about_click(parent=self._iface.mainWindow()))
         self.provider_refresh.clicked.connect(self._on_prov_refresh_click)
+        self.provider_combo.currentIndexChanged.connect(self.warm_up_provider)
         self.time_button_group.buttonToggled.connect(self._on_time_button_toggle)
 
         # Routing tab
@@ -590,6 +595,12 @@ class ValhallaDialog(QDialog, Ui_ValhallaDialogBase):
             for idx, loc in enumerate(j):
                 self.routing_fromline_list.addItem("Point {0}: {1:.6f}, {2:.6f}".format(idx, loc['lon'], loc['lat']))
 
+    def warm_up_provider(self):
+        """Pre-connects to the currently selected provider, so the first request doesn't wait for the handshake."""
+        provider = self.provider_combo.currentData()
+        if provider:
+            client.get_client(provider).warm_up()
+
     def _on_prov_refresh_click(self):
         """Populates provider dropdown with fresh list from config.yml"""
 
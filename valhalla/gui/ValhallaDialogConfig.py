@@ -31,6 +31,7 @@ from PyQt5.QtWidgets import QDialog, QInputDialog
 from qgis.gui import QgsCollapsibleGroupBox
 
 from .ValhallaDialogConfigUI_ui import Ui_ValhallaDialogConfigBase
+from ..common import capabilities
 from ..utils import configmanager
 
 
@@ -63,8 +64,11 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
             current_provider = self.temp_config['providers'][idx]
             current_provider['key'] = box.findChild(QtWidgets.QLineEdit, box.title() + "_key_text").text()
             current_provider['base_url'] = box.findChild(QtWidgets.QLineEdit, box.title() + "_base_url_text").text()
+            current_provider['gzip_threshold'] = box.findChild(QtWidgets.QSpinBox, box.title() + "_gzip_threshold_spin").value()
 
         configmanager.write_config(self.temp_config)
+        # URLs or limits might have changed
+        capabilities.clear_cache()
         self.close()
 
     def _build_ui(self):
@@ -74,6 +78,7 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
             self._add_box(provider_entry['name'],
                           provider_entry['base_url'],
                           provider_entry['key'],
+                          provider_entry.get('gzip_threshold', 0),
                           new=False)
 
         self.gridLayout.addWidget(self.providers, 0, 0, 1, 3)
@@ -90,7 +95,7 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
         # Show quick user input dialog
         provider_name, ok = QInputDialog.getText(self, "New ORS provider", "Enter a name for the provider")
         if ok:
-            self._add_box(provider_name, 'https://', '', new=True)
+            self._add_box(provider_name, 'https://', '', 0, new=True)
 
     def _remove_provider(self):
         """Remove list of providers from list."""
@@ -121,6 +126,7 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
                  name,
                  url,
                  key,
+                 gzip_threshold=0,
                  new=False):
         """
         Adds a provider box to the QWidget layout and self.temp_config.
@@ -134,6 +140,9 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
         :param key: user's API key
         :type key: str
 
+        :param gzip_threshold: request body size in bytes above which requests are gzipped, 0 to disable.
+        :type gzip_threshold: int
+
         :param new: Specifies whether user wants to insert provider or the GUI is being built.
         :type new: boolean
         """
@@ -143,6 +152,7 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
                     name=name,
                     base_url=url,
                     key=key,
+                    gzip_threshold=gzip_threshold,
                 )
             )
 
@@ -167,5 +177,14 @@ class ValhallaDialogConfigMain(QDialog, Ui_ValhallaDialogConfigBase):
         base_url_label.setObjectName("base_url_label")
         base_url_label.setText("Base URL")
         gridLayout_3.addWidget(base_url_label, 2, 0, 1, 1)
+        gzip_threshold_label = QtWidgets.QLabel(provider)
+        gzip_threshold_label.setObjectName(name + '_gzip_threshold_label')
+        gzip_threshold_label.setText('Gzip requests larger than (bytes, 0 to disable)')
+        gridLayout_3.addWidget(gzip_threshold_label, 4, 0, 1, 1)
+        gzip_threshold_spin = QtWidgets.QSpinBox(provider)
+        gzip_threshold_spin.setObjectName(name + "_gzip_threshold_spin")
+        gzip_threshold_spin.setMaximum(2147483647)
+        gzip_threshold_spin.setValue(gzip_threshold)
+        gridLayout_3.addWidget(gzip_threshold_spin, 5, 0, 1, 4)
         self.verticalLayout.addWidget(provider)
         provider.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed)
@@ -24,20 +24,58 @@
  ***************************************************************************/
 """
 from collections import OrderedDict
+import os.path
 import shlex
-import subprocess
-from lxml import etree
+import sqlite3
 
 from PyQt5.QtCore import QVariant
-from qgis.core import (QgsFields,
+from qgis.core import (QgsApplication,
+                       QgsFields,
                        QgsField,
                        QgsFeature,
                        QgsPointXY,
-                       QgsGeometry)
+                       QgsGeometry,
+                       QgsTask)
 
+from ..utils import configmanager, logger, osm_index
 from ..utils.convert import decode_polyline6
 from ..gui.common_gui import get_locations, get_costing_options
 
+# Way tag index builds running in the background and PBF files whose build failed in this session, by PBF path
+_BUILD_TASKS = dict()
+_FAILED_BUILDS = set()
+
+
+def _start_index_build(index):
+    """
+    Builds a way tag index in a background task, once per PBF file and session.
+
+    :param index: index to build
+    :type index: valhalla.utils.osm_index.WayTagIndex
+    """
+    path = index.pbf_path
+    if path in _BUILD_TASKS or path in _FAILED_BUILDS:
+        return
+
+    def run(task):
+        index.build()
+
+    def finished(exception, result=None):
+        _BUILD_TASKS.pop(path, None)
+        if exception is not None:
+            _FAILED_BUILDS.add(path)
+            logger.log(f"Building the way tag index {index.index_path} failed, osmium getid is used instead: "
+                       f"{exception}", 1)
+        else:
+            logger.log(f"Way tag index {index.index_path} is ready.", 0)
+
+    logger.log(f"Building the way tag index {index.index_path} in the background, once per PBF file.", 0)
+    # Keep a reference, the task manager doesn't keep the Python object alive
+    task = _BUILD_TASKS[path] = QgsTask.fromFunction(
+        f"Valhalla: indexing ways of {os.path.basename(path)}", run, on_finished=finished
+    )
+    QgsApplication.taskManager().addTask(task)
+
 
 class Identify:
     """Extended functionality for directions endpoint for GUI."""
@@ -122,37 +160,56 @@ class Identify:
 
     def get_tags(self, response):
         """
-        Returns the tags from the list of OSM ID's passed from the locate endpoint.
+        Returns the tags from the list of OSM ID's passed from the locate endpoint. Tags are extracted with osmium
+        getid, unless the way tag index is enabled in config.yml and already built for this PBF. Otherwise the
+        index is built in a background task for later lookups.
 
         :returns: dict of way information, e.g. {<way_id>: {'tags': ['maxspeed=50'], 'shape': 'osagja2p@592'}}
         :rtype: OrderedDict
         """
-        cmd = f"osmium getid -o - -f osm --no-progress --default-type=w {self.path}"
-
-        # Parse response from locate and build osmium command
+        # Parse response from locate
         edges_parsed = OrderedDict()
         for edge_cluster in response:
             for edge in edge_cluster['edges']:
                 idx = edge['edge_info']['way_id']
                 edges_parsed[idx] = dict()
                 edges_parsed[idx]['geometry'] = decode_polyline6(edge['edge_info']['shape'])
+                edges_parsed[idx]['tags'] = list()
+
+        way_ids = list(edges_parsed)
+        tags = None
+        settings = configmanager.read_config().get('identify') or {}
+        if settings.get('build_index', False):
+            index = osm_index.WayTagIndex(self.path)
+            try:
+                if index.is_current():
+                    tags = index.get_tags(way_ids)
+                else:
+                    _start_index_build(index)
+            except (OSError, sqlite3.Error) as e:
+                logger.log(f"Way tag index unavailable, falling back to osmium getid: {e}", 1)
+
+        if tags is None:
+            tags = self._get_tags_osmium(way_ids)
+
+        for idx, way_tags in tags.items():
+            edges_parsed[idx]['tags'] = way_tags
+
+        return edges_parsed
+
+    def _get_tags_osmium(self, way_ids):
+        """
+        Extracts the tags of ways from the PBF with osmium getid. The OPL output is parsed line by line while osmium
+        runs, so memory doesn't grow with the size of the output.
+
+        :param way_ids: OSM way IDs
+        :type way_ids: list of int
+
+        :returns: tags in 'key=value' format by way ID
+        :rtype: dict
+        """
+        cmd = f"osmium getid -o - -f opl --no-progress --default-type=w {shlex.quote(self.path)}"
+        for idx in way_ids:
+            cmd += f' {str(idx)}'
 
-                cmd += f' {str(idx)}'
-
-        # Run osmium command
-        try:
-            output = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError as e:
-            raise e
-
-        # Parse XML from osmium output and include to edges dict
-        root_xml = etree.ElementTree(etree.fromstring(output.stdout))
-        ways_xml = root_xml.findall('way')
-        for way in ways_xml:
-            idx = int(way.get('id'))
-            tags_xml = way.findall('tag')
-            edges_parsed[idx]['tags'] = list()
-            for tag in tags_xml:
-                edges_parsed[idx]['tags'].append("=".join(tag.values()))
-
-        return edges_parsed
\ No newline at end of file
+        return dict(osm_index.iter_osmium_ways(cmd))
\ No newline at end of file
@@ -25,8 +25,9 @@
 """
 from qgis.core import QgsGeometry, QgsWkbTypes, QgsVectorLayer
 
+from ..common import trace_attributes_core
 from ..gui.common_gui import get_locations, get_costing_options
-from ..utils import transform
+from ..utils import transform, features
 
 
 class TraceAttributes:
@@ -56,7 +57,9 @@ class TraceAttributes:
             'costing': profile,
             'id': 1,
             'shape': get_locations(self.dlg.routing_fromline_list),
-            'shape_match': 'map_snap'
+            'shape_match': 'map_snap',
+            # Only request what's output
+            'filters': trace_attributes_core.get_filters()
         }
 
         # Get Advanced parameters
@@ -70,22 +73,19 @@ class TraceAttributes:
             poly_layer: QgsVectorLayer = self.dlg.avoidpolygons_dropdown.currentLayer()
             if point_layer:
                 locations = list()
-                transformer = transform.transformToWGS(point_layer.sourceCrs())
-                for feat in point_layer.getFeatures():
-                    geom = feat.geometry()
-                    geom.transform(transformer)
-                    point = geom.asPoint()
-
+                points = transform.transform_points(
+                    [feat.geometry().asPoint() for feat in features.get_features(point_layer, sort=False)],
+                    point_layer.sourceCrs()
+                )
+                for point in points:
                     locations.append({'lon': round(point.x(), 6), 'lat': round(point.y(), 6)})
                 params['avoid_locations'] = locations
             if poly_layer:
                 if poly_layer.wkbType() in (QgsWkbTypes.MultiPolygon, QgsWkbTypes.MultiPolygonZ, QgsWkbTypes.MultiPolygonZM):
                     raise ValueError("Only Polygon layers are allowed as AvoidPolygon layer")
                 locations = list()
-                transformer = transform.transformToWGS(poly_layer.sourceCrs())
-                for feat in poly_layer.getFeatures():
-                    geom: QgsGeometry = feat.geometry()
-                    geom.transform(transformer)
+                for feat in features.get_features(poly_layer, sort=False):
+                    geom: QgsGeometry = transform.transform_geometry(feat.geometry(), poly_layer.sourceCrs())
                     locations.append([[p.x(), p.y()] for p in geom.asPolygon()[0]])
                 params['avoid_polygons'] = locations
 
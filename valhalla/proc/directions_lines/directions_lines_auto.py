@@ -37,12 +37,13 @@ from qgis.core import (QgsWkbTypes,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessingParameterFeatureSink,
-                       QgsPointXY,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingException,
                        )
 from .. import HELP_DIR
 from ... import RESOURCE_PREFIX, __help__
-from ...common import client, directions_core
-from ...utils import configmanager, transform, exceptions,logger
+from ...common import client, capabilities, directions_core
+from ...utils import configmanager, transform, exceptions, logger, arrow_export, batching, features
 from ..costing_params import CostingAuto
 from ..request_builder import get_directions_params, get_avoid_locations
 
@@ -65,6 +66,7 @@ class ValhallaRouteLinesCarAlgo(QgsProcessingAlgorithm):
     IN_MODE = "INPUT_MODE"
     IN_AVOID = "avoid_locations"
     OUT = 'OUTPUT'
+    OUT_ARROW = 'OUTPUT_ARROW'
 
     def __init__(self):
         super(ValhallaRouteLinesCarAlgo, self).__init__()
@@ -126,6 +128,17 @@ class ValhallaRouteLinesCarAlgo(QgsProcessingAlgorithm):
             QgsProcessingParameterFeatureSink(
                 name=self.OUT,
                 description="Routing " + self.PROFILE.capitalize() + " From LineString",
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUT_ARROW,
+                description="Routing " + self.PROFILE.capitalize() + " From LineString as GeoParquet/Arrow",
+                fileFilter=arrow_export.FILE_FILTER,
+                optional=True,
                 createByDefault=False
             )
         )
@@ -169,9 +182,15 @@ class ValhallaRouteLinesCarAlgo(QgsProcessingAlgorithm):
         # Init ORS client
         providers = configmanager.read_config()['providers']
         provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
-        clnt = client.Client(provider)
+        clnt = client.get_client(provider)
+        clnt.warm_up()
         clnt.overQueryLimit.connect(lambda : feedback.reportError("OverQueryLimit: Retrying..."))
 
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/route'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /route.")
+        max_locations = provider_caps.limit(self.PROFILE, 'max_locations')
+
         # Get parameter values
         source = self.parameterAsSource(
             parameters,
@@ -198,54 +217,80 @@ class ValhallaRouteLinesCarAlgo(QgsProcessingAlgorithm):
         if avoid_layer:
             params['avoid_locations'] = get_avoid_locations(avoid_layer)
 
+        fields = directions_core.get_fields(from_type=source.fields().field(source_field_name).type(),
+                                            from_name=source_field_name,
+                                            line=True)
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUT, context,
-                                               directions_core.get_fields(from_type=source.fields().field(source_field_name).type(),
-                                                                          from_name=source_field_name,
-                                                                          line=True),
+                                               fields,
                                                source.wkbType(),
                                                QgsCoordinateReferenceSystem(4326))
-
-        count = source.featureCount()
-        for num, (line, field_value) in enumerate(self._get_sorted_lines(source, source_field_name)):
-            # Stop the algorithm if cancel button has been clicked
-            if feedback.isCanceled():
-                break
-
-            params.update(get_directions_params(line, self.PROFILE, self.costing_options, mode))
-            params['id'] = field_value
-
-            try:
-                response = clnt.request('/route', post_json=params)
-            except (exceptions.ApiError) as e:
-                msg = "Feature ID {} caused a {}:\n{}".format(
-                    field_value,
-                    e.__class__.__name__,
-                    str(e))
-                feedback.reportError(msg)
-                logger.log(msg)
-                continue
-
-            except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
-                msg = "{}:\n{}".format(
-                    e.__class__.__name__,
-                    str(e))
-                logger.log(msg)
-                raise
-
-            options = {}
-            if params.get('costing_options'):
-                options = params['costing_options']
-
-            sink.addFeature(directions_core.get_output_feature_directions(
-                response,
-                self.PROFILE,
-                options.get(self.PROFILE),
-                from_value=field_value
-            ))
-
-            feedback.setProgress(int(100.0 / count * num))
-
-        return {self.OUT: dest_id}
+        arrow_path = self.parameterAsFileOutput(parameters, self.OUT_ARROW, context)
+        (sink, arrow_sink) = arrow_export.get_sink(arrow_path, fields, sink)
+        try:
+            if sink is None:
+                raise QgsProcessingException("ParameterError: Please set at least one of the outputs.")
+            sink = batching.BatchedSink(sink)
+
+            count = source.featureCount()
+            for num, (line, field_value) in enumerate(self._get_sorted_lines(source, source_field_name)):
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
+
+                # Don't bother the server with requests it will reject
+                if max_locations and len(line) > max_locations:
+                    feedback.reportError(
+                        f"Feature ID {field_value} has {len(line)} locations, but the provider allows only {max_locations}."
+                    )
+                    continue
+
+                params.update(get_directions_params(line, self.PROFILE, self.costing_options, mode))
+                params['id'] = field_value
+
+                try:
+                    response = clnt.request('/route', post_json=params)
+                except (exceptions.ApiError) as e:
+                    msg = "Feature ID {} caused a {}:\n{}".format(
+                        field_value,
+                        e.__class__.__name__,
+                        str(e))
+                    feedback.reportError(msg)
+                    logger.log(msg, 1)
+                    continue
+
+                except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
+                    msg = "{}:\n{}".format(
+                        e.__class__.__name__,
+                        str(e))
+                    logger.log(msg, 2)
+                    raise
+
+                options = {}
+                if params.get('costing_options'):
+                    options = params['costing_options']
+
+                sink.addFeature(directions_core.get_output_feature_directions(
+                    response,
+                    self.PROFILE,
+                    options.get(self.PROFILE),
+                    from_value=field_value
+                ))
+
+                feedback.setProgress(int(100.0 / count * num))
+
+            sink.flush()
+        finally:
+            # Finalize the file also if the run fails or is canceled
+            if arrow_sink is not None:
+                arrow_sink.close()
+
+        results = {self.OUT: dest_id}
+        if arrow_sink is not None:
+            results[self.OUT_ARROW] = arrow_path
+
+        logger.flush()
+
+        return results
 
     @staticmethod
     def _get_sorted_lines(layer, field_name):
@@ -259,19 +304,18 @@ class ValhallaRouteLinesCarAlgo(QgsProcessingAlgorithm):
         :param field_name: name of ID field
         :type field_name: str
         """
-        # First get coordinate transformer
-        xformer = transform.transformToWGS(layer.sourceCrs())
+        crs = layer.sourceCrs()
 
-        for feat in sorted(layer.getFeatures(), key=lambda f: f.id()):
+        for feat in features.get_features(layer, [field_name]):
             line = None
             field_value = feat[field_name]
             # for
             if layer.wkbType() == QgsWkbTypes.MultiLineString:
                 # TODO: only takes the first polyline geometry from the multiline geometry currently
                 # Loop over all polyline geometries
-                line = [xformer.transform(QgsPointXY(point)) for point in feat.geometry().asMultiPolyline()[0]]
+                line = transform.transform_points(feat.geometry().asMultiPolyline()[0], crs)
 
             elif layer.wkbType() == QgsWkbTypes.LineString:
-                line = [xformer.transform(QgsPointXY(point)) for point in feat.geometry().asPolyline()]
+                line = transform.transform_points(feat.geometry().asPolyline(), crs)
 
             yield line, field_value
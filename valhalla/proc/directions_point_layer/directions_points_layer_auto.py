@@ -36,14 +36,15 @@ from qgis.core import (QgsWkbTypes,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingException,
                        QgsProcessingParameterDefinition,
                        QgsProcessingParameterMapLayer,
-                       QgsPointXY,
                        )
 from .. import HELP_DIR
 from ... import RESOURCE_PREFIX, __help__
-from ...common import client, directions_core
-from ...utils import configmanager, transform, exceptions,logger
+from ...common import client, capabilities, directions_core
+from ...utils import configmanager, transform, exceptions, logger, arrow_export, batching, features
 from ..costing_params import CostingAuto
 from ..request_builder import get_directions_params, get_avoid_locations
 
@@ -64,6 +65,7 @@ class ValhallaRoutePointsLayerCarAlgo(QgsProcessingAlgorithm):
     IN_MODE = "INPUT_MODE"
     IN_AVOID = "avoid_locations"
     OUT = 'OUTPUT'
+    OUT_ARROW = 'OUTPUT_ARROW'
 
     def __init__(self):
         super(ValhallaRoutePointsLayerCarAlgo, self).__init__()
@@ -125,6 +127,17 @@ class ValhallaRoutePointsLayerCarAlgo(QgsProcessingAlgorithm):
             QgsProcessingParameterFeatureSink(
                 name=self.OUT,
                 description="Routing " + self.PROFILE.capitalize() + " From Point",
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUT_ARROW,
+                description="Routing " + self.PROFILE.capitalize() + " From Point as GeoParquet/Arrow",
+                fileFilter=arrow_export.FILE_FILTER,
+                optional=True,
                 createByDefault=False
             )
         )
@@ -168,9 +181,15 @@ class ValhallaRoutePointsLayerCarAlgo(QgsProcessingAlgorithm):
 
         providers = configmanager.read_config()['providers']
         provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
-        clnt = client.Client(provider)
+        clnt = client.get_client(provider)
+        clnt.warm_up()
         clnt.overQueryLimit.connect(lambda : feedback.reportError("OverQueryLimit: Retrying..."))
 
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/route'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /route.")
+        max_locations = provider_caps.limit(self.PROFILE, 'max_locations')
+
         mode = self.MODE_TYPES[self.parameterAsEnum(parameters, self.IN_MODE, context)]
 
         # Get parameter values
@@ -192,77 +211,99 @@ class ValhallaRoutePointsLayerCarAlgo(QgsProcessingAlgorithm):
             context
         )
 
+        fields = directions_core.get_fields(from_type=source.fields().field(source_field_name).type(),
+                                            from_name=source_field_name,
+                                            line=True)
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUT, context,
-                                               directions_core.get_fields(from_type=source.fields().field(source_field_name).type(),
-                                                                          from_name=source_field_name,
-                                                                          line=True),
+                                               fields,
                                                QgsWkbTypes.LineString,
                                                QgsCoordinateReferenceSystem(4326))
-        input_points = list()
-        from_values = list()
-        xformer_source = transform.transformToWGS(source.sourceCrs())
-
-        if source.wkbType() == QgsWkbTypes.Point:
-            points = list()
-            for feat in sorted(source.getFeatures(), key=lambda f: f.id()):
-                points.append(xformer_source.transform(QgsPointXY(feat.geometry().asPoint())))
-            input_points.append(points)
-            from_values.append('')
-        elif source.wkbType() == QgsWkbTypes.MultiPoint:
-            # loop through multipoint features
-            for feat in sorted(source.getFeatures(), key=lambda f: f.id()):
-                points = list()
-                for point in feat.geometry().asMultiPoint():
-                    points.append(xformer_source.transform(QgsPointXY(point)))
+        arrow_path = self.parameterAsFileOutput(parameters, self.OUT_ARROW, context)
+        (sink, arrow_sink) = arrow_export.get_sink(arrow_path, fields, sink)
+        try:
+            if sink is None:
+                raise QgsProcessingException("ParameterError: Please set at least one of the outputs.")
+            sink = batching.BatchedSink(sink)
+            input_points = list()
+            from_values = list()
+            crs = source.sourceCrs()
+
+            if source.wkbType() == QgsWkbTypes.Point:
+                points = transform.transform_points([feat.geometry().asPoint() for feat in features.get_features(source)], crs)
                 input_points.append(points)
-                from_values.append(feat[source_field_name])
-
-        count = source.featureCount()
-
-        params = dict()
-        if avoid_layer:
-            params['avoid_locations'] = get_avoid_locations(avoid_layer)
-
-        # Sets all advanced parameters as attributes of self.costing_options
-        self.costing_options.set_costing_options(self, parameters, context)
-
-        for num, (points, from_value) in enumerate(zip(input_points, from_values)):
-            # Stop the algorithm if cancel button has been clicked
-            if feedback.isCanceled():
-                break
-
-            params.update(get_directions_params(points, self.PROFILE, self.costing_options, mode))
-            params['id'] = from_value
-
-            try:
-                response = clnt.request('/route', post_json=params)
-            except (exceptions.ApiError) as e:
-                msg = "Feature ID {} caused a {}:\n{}".format(
-                    from_value,
-                    e.__class__.__name__,
-                    str(e))
-                feedback.reportError(msg)
-                logger.log(msg)
-                continue
-
-            except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
-                msg = "{}:\n{}".format(
-                    e.__class__.__name__,
-                    str(e))
-                logger.log(msg)
-                raise
-
-            options = {}
-            if params.get('costing_options'):
-                options = params['costing_options']
-
-            sink.addFeature(directions_core.get_output_feature_directions(
-                response,
-                self.PROFILE,
-                options.get(self.PROFILE),
-                from_value=from_value
-            ))
-
-            feedback.setProgress(int(100.0 / count * num))
-
-        return {self.OUT: dest_id}
+                from_values.append('')
+            elif source.wkbType() == QgsWkbTypes.MultiPoint:
+                # loop through multipoint features
+                for feat in features.get_features(source, [source_field_name]):
+                    points = transform.transform_points(feat.geometry().asMultiPoint(), crs)
+                    input_points.append(points)
+                    from_values.append(feat[source_field_name])
+
+            count = source.featureCount()
+
+            params = dict()
+            if avoid_layer:
+                params['avoid_locations'] = get_avoid_locations(avoid_layer)
+
+            # Sets all advanced parameters as attributes of self.costing_options
+            self.costing_options.set_costing_options(self, parameters, context)
+
+            for num, (points, from_value) in enumerate(zip(input_points, from_values)):
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
+
+                # Don't bother the server with requests it will reject
+                if max_locations and len(points) > max_locations:
+                    feedback.reportError(
+                        f"Feature ID {from_value} has {len(points)} locations, but the provider allows only {max_locations}."
+                    )
+                    continue
+
+                params.update(get_directions_params(points, self.PROFILE, self.costing_options, mode))
+                params['id'] = from_value
+
+                try:
+                    response = clnt.request('/route', post_json=params)
+                except (exceptions.ApiError) as e:
+                    msg = "Feature ID {} caused a {}:\n{}".format(
+                        from_value,
+                        e.__class__.__name__,
+                        str(e))
+                    feedback.reportError(msg)
+                    logger.log(msg, 1)
+                    continue
+
+                except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
+                    msg = "{}:\n{}".format(
+                        e.__class__.__name__,
+                        str(e))
+                    logger.log(msg, 2)
+                    raise
+
+                options = {}
+                if params.get('costing_options'):
+                    options = params['costing_options']
+
+                sink.addFeature(directions_core.get_output_feature_directions(
+                    response,
+                    self.PROFILE,
+                    options.get(self.PROFILE),
+                    from_value=from_value
+                ))
+
+                feedback.setProgress(int(100.0 / count * num))
+
+            sink.flush()
+        finally:
+            # Finalize the file also if the run fails or is canceled
+            if arrow_sink is not None:
+                arrow_sink.close()
+
+        results = {self.OUT: dest_id}
+        if arrow_sink is not None:
+            results[self.OUT_ARROW] = arrow_path
+
+        logger.flush()
+
+        return results
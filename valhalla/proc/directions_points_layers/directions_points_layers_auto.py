@@ -36,14 +36,17 @@ from qgis.core import (QgsWkbTypes,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingException,
                        QgsProcessingParameterDefinition,
+                       QgsProcessingParameterBoolean,
                        )
 from .. import HELP_DIR
 from ... import RESOURCE_PREFIX, __help__
-from ...common import client, directions_core
-from ...utils import configmanager, transform, exceptions,logger
+from ...common import client, capabilities, directions_core, locate_core
+from ...utils import configmanager, transform, exceptions, logger, arrow_export, batching, features, fingerprint
 from ..costing_params import CostingAuto
-from ..request_builder import get_directions_params, get_avoid_locations
+from ..request_builder import get_directions_params, get_avoid_locations, get_costing_options
 
 
 class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
@@ -66,7 +69,10 @@ class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
     IN_MATRIX_MODE = "INPUT_MATRIX_MODE"
     IN_MODE = "INPUT_MODE"
     IN_AVOID = "avoid_locations"
+    IN_PRESNAP = "INPUT_PRESNAP"
+    IN_PREVIOUS = "INPUT_PREVIOUS"
     OUT = 'OUTPUT'
+    OUT_ARROW = 'OUTPUT_ARROW'
 
     def __init__(self):
         super(ValhallaRoutePointsLayersCarAlgo, self).__init__()
@@ -143,7 +149,23 @@ class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
             )
         )
 
-        advanced = self.costing_options.get_costing_params()
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                name=self.IN_PREVIOUS,
+                description="Previous output to update, only new or changed routes are requested",
+                types=[QgsProcessing.TypeVectorLine],
+                optional=True
+            )
+        )
+
+        advanced = [
+            QgsProcessingParameterBoolean(
+                name=self.IN_PRESNAP,
+                description="Snap locations first (once per unique location with /locate)",
+                defaultValue=False
+            )
+        ]
+        advanced.extend(self.costing_options.get_costing_params())
 
         for p in advanced:
             p.setFlags(p.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
@@ -153,6 +175,17 @@ class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
             QgsProcessingParameterFeatureSink(
                 name=self.OUT,
                 description="Routing " + self.PROFILE.capitalize() + " From 2 Points",
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUT_ARROW,
+                description="Routing " + self.PROFILE.capitalize() + " From 2 Points as GeoParquet/Arrow",
+                fileFilter=arrow_export.FILE_FILTER,
+                optional=True,
                 createByDefault=False
             )
         )
@@ -197,9 +230,14 @@ class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
 
         providers = configmanager.read_config()['providers']
         provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
-        clnt = client.Client(provider)
+        clnt = client.get_client(provider)
+        clnt.warm_up()
         clnt.overQueryLimit.connect(lambda : feedback.reportError("OverQueryLimit: Retrying..."))
 
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/route'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /route.")
+
         mode = self.MODE_TYPES[self.parameterAsEnum(parameters, self.IN_MODE, context)]
 
         # Get parameter values
@@ -254,63 +292,139 @@ class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
         else:
             route_count = source.featureCount() * destination.featureCount()
 
+        fields = directions_core.get_fields(source_field.type(), destination_field.type(), fingerprint=True)
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUT, context,
-                                               directions_core.get_fields(source_field.type(), destination_field.type()),
+                                               fields,
                                                QgsWkbTypes.LineString,
                                                QgsCoordinateReferenceSystem(4326))
-
-        counter = 0
-
-        params = dict()
-        if avoid_layer:
-            params['avoid_locations'] = get_avoid_locations(avoid_layer)
-
-        # Sets all advanced parameters as attributes of self.costing_options
-        self.costing_options.set_costing_options(self, parameters, context)
-
-        for points, values in directions_core.get_request_point_features(route_dict, matrix_mode):
-            # Stop the algorithm if cancel button has been clicked
-            if feedback.isCanceled():
-                break
-
-            params.update(get_directions_params(points, self.PROFILE, self.costing_options, mode))
-            params['id'] = f"{values[0]} & {values[1]}"
-
-            try:
-                response = clnt.request('/route', post_json=params)
-            except (exceptions.ApiError) as e:
-                msg = "Route from {} to {} caused a {}:\n{}".format(
-                    values[0],
-                    values[1],
-                    e.__class__.__name__,
-                    str(e))
-                feedback.reportError(msg)
-                logger.log(msg)
-                continue
-
-            except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
-                msg = "{}:\n{}".format(
-                    e.__class__.__name__,
-                    str(e))
-                logger.log(msg)
-                raise
-
-            options = {}
-            if params.get('costing_options'):
-                options = params['costing_options']
-
-            sink.addFeature(directions_core.get_output_feature_directions(
-                response,
-                self.PROFILE,
-                options.get(self.PROFILE),
-                from_value=values[0],
-                to_value=values[1]
-            ))
-
-            counter += 1
-            feedback.setProgress(int(100.0 / route_count * counter))
-
-        return {self.OUT: dest_id}
+        arrow_path = self.parameterAsFileOutput(parameters, self.OUT_ARROW, context)
+        (sink, arrow_sink) = arrow_export.get_sink(arrow_path, fields, sink)
+        try:
+            if sink is None:
+                raise QgsProcessingException("ParameterError: Please set at least one of the outputs.")
+            sink = batching.BatchedSink(sink)
+
+            # Results of an earlier run by fingerprint, unchanged routes are copied forward instead of requested
+            previous = None
+            previous_source = self.parameterAsSource(parameters, self.IN_PREVIOUS, context)
+            if previous_source is not None:
+                previous = fingerprint.get_previous_features(previous_source)
+                if previous is None:
+                    raise QgsProcessingException(
+                        "ParameterError: The previous output has no fingerprint field, it can't be updated."
+                    )
+
+            counter = 0
+            reused = 0
+
+            params = dict()
+            if avoid_layer:
+                params['avoid_locations'] = get_avoid_locations(avoid_layer)
+
+            # Sets all advanced parameters as attributes of self.costing_options
+            self.costing_options.set_costing_options(self, parameters, context)
+
+            max_distance = provider_caps.limit(self.PROFILE, 'max_distance')
+            # Fingerprints are taken from the input locations, so routes found in the previous output are copied
+            # forward before any location is snapped
+            pending = []
+            for points, values in directions_core.get_request_point_features(route_dict, matrix_mode, max_distance):
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
+
+                if points is None:
+                    counter += 1
+                    feedback.reportError(
+                        f"Route from {values[0]} to {values[1]} is longer than the provider's max_distance "
+                        f"of {max_distance} m, skipped."
+                    )
+                    continue
+
+                params.update(get_directions_params(points, self.PROFILE, self.costing_options, mode))
+                fp = fingerprint.get_fingerprint(points, values, fingerprint.get_params_hash(params, provider['base_url']))
+                if previous and fp in previous:
+                    counter += 1
+                    reused += 1
+                    sink.addFeatures(fingerprint.copy_features(previous.pop(fp), fields))
+                    feedback.setProgress(int(100.0 / route_count * counter))
+                    continue
+
+                pending.append((points, values, fp))
+
+            # Only the locations of routes which are actually requested are snapped
+            snapped = dict()
+            if pending and self.parameterAsBool(parameters, self.IN_PRESNAP, context) and \
+                    provider_caps.has_action('/locate'):
+                feedback.pushInfo("Snapping unique locations...")
+                snapped = locate_core.snap_locations(
+                    clnt,
+                    [point for points, _, _ in pending for point in points],
+                    self.PROFILE,
+                    get_costing_options(self.costing_options, self.PROFILE, mode),
+                    provider_caps.limit(self.PROFILE, 'max_locations') or 20
+                )
+
+            for points, values, fp in pending:
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
+
+                counter += 1
+                params.update(get_directions_params(
+                    locate_core.apply_snapped(points, snapped), self.PROFILE, self.costing_options, mode
+                ))
+                params['id'] = f"{values[0]} & {values[1]}"
+
+                try:
+                    response = clnt.request('/route', post_json=params)
+                except (exceptions.ApiError) as e:
+                    msg = "Route from {} to {} caused a {}:\n{}".format(
+                        values[0],
+                        values[1],
+                        e.__class__.__name__,
+                        str(e))
+                    feedback.reportError(msg)
+                    logger.log(msg, 1)
+                    continue
+
+                except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
+                    msg = "{}:\n{}".format(
+                        e.__class__.__name__,
+                        str(e))
+                    logger.log(msg, 2)
+                    raise
+
+                options = {}
+                if params.get('costing_options'):
+                    options = params['costing_options']
+
+                sink.addFeature(directions_core.get_output_feature_directions(
+                    response,
+                    self.PROFILE,
+                    options.get(self.PROFILE),
+                    from_value=values[0],
+                    to_value=values[1],
+                    fingerprint=fp
+                ))
+
+                feedback.setProgress(int(100.0 / route_count * counter))
+
+            sink.flush()
+        finally:
+            # Finalize the file also if the run fails or is canceled
+            if arrow_sink is not None:
+                arrow_sink.close()
+
+        if previous is not None:
+            feedback.pushInfo(f"Reused {reused} unchanged routes from the previous output.")
+        results = {self.OUT: dest_id}
+        if arrow_sink is not None:
+            results[self.OUT_ARROW] = arrow_path
+
+        logger.flush()
+
+        return results
 
     def _get_route_dict(self, source, source_field, destination, destination_field):
         """
@@ -333,17 +447,16 @@ class ValhallaRoutePointsLayersCarAlgo(QgsProcessingAlgorithm):
         """
         route_dict = dict()
 
-        source_feats = list(source.getFeatures())
-        xformer_source = transform.transformToWGS(source.sourceCrs())
+        source_feats = list(features.get_features(source, [source_field.name()], sort=False))
         route_dict['start'] = dict(
-            geometries=[xformer_source.transform(feat.geometry().asPoint()) for feat in source_feats],
+            geometries=transform.transform_points([feat.geometry().asPoint() for feat in source_feats], source.sourceCrs()),
             values= [feat.attribute(source_field.name()) for feat in source_feats],
         )
 
-        destination_feats = list(destination.getFeatures())
-        xformer_destination = transform.transformToWGS(destination.sourceCrs())
+        destination_feats = list(features.get_features(destination, [destination_field.name()], sort=False))
         route_dict['end'] = dict(
-            geometries=[xformer_destination.transform(feat.geometry().asPoint()) for feat in destination_feats],
+            geometries=transform.transform_points([feat.geometry().asPoint() for feat in destination_feats],
+                                                  destination.sourceCrs()),
             values= [feat.attribute(destination_field.name()) for feat in destination_feats],
         )
 
@@ -24,12 +24,14 @@
  ***************************************************************************/
 """
 import os.path
+from collections import OrderedDict
 from copy import deepcopy
 from typing import Optional
 
 from PyQt5.QtGui import QIcon
 
 from qgis.core import (QgsWkbTypes,
+                       QgsPointXY,
                        QgsCoordinateReferenceSystem,
                        QgsProcessing,
                        QgsProcessingUtils,
@@ -40,6 +42,8 @@ from qgis.core import (QgsWkbTypes,
                        QgsProcessingParameterEnum,
                        QgsVectorLayer,
                        QgsProcessingParameterString,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterFileDestination,
                        QgsProcessingParameterDefinition,
                        QgsProcessingException,
                        QgsProcessingOutputVectorLayer,
@@ -47,10 +51,14 @@ QgsProcessingContext
                        )
 from .. import HELP_DIR
 from ... import RESOURCE_PREFIX, __help__
-from ...common import client, isochrones_core
-from ...utils import configmanager, transform, exceptions,logger
+from ...common import client, capabilities, isochrones_core, locate_core
+from ...utils import (configmanager, transform, exceptions, logger, arrow_export, batching, features, fingerprint,
+                      distance)
 from ..costing_params import CostingAuto
-from ..request_builder import get_directions_params, get_avoid_locations
+from ..request_builder import get_directions_params, get_avoid_locations, get_costing_options
+
+# Number of grid cell responses kept for sharing, least recently used ones are dropped first
+RESPONSE_CACHE_SIZE = 64
 
 
 class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
@@ -77,10 +85,15 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
     IN_GENERALIZE = 'generalize'
     IN_GEOMETRY = 'polygons'
     IN_AVOID = "avoid_locations"
+    IN_PRESNAP = "INPUT_PRESNAP"
+    IN_PREVIOUS = "INPUT_PREVIOUS"
+    IN_CACHE_TOLERANCE = "INPUT_CACHE_TOLERANCE"
+    IN_BANDS = "INPUT_BANDS"
     OUT_TIME = 'OUTPUT_TIME'
     OUT_DISTANCE = 'OUTPUT_DISTANCE'
     POINTS_SNAPPED = 'OUTPUT_SNAPPED_POINTS'
     POINTS_INPUT = 'OUTPUT_INPUT_POINTS'
+    OUT_ARROW = 'OUTPUT_ARROW'
 
     # Save some important references
     isos_time_id = None
@@ -96,6 +109,7 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
         self.costing_options = self.COSTING()
         self.intervals = None  # will be populated with the intervals available
         self.isos_time_id, self.isos_dist_id, self.points_input_id, self.points_snapped_id = None, None, None, None
+        self.arrow_path = None
 
 
     def initAlgorithm(self, configuration, p_str=None, Any=None, *args, **kwargs):
@@ -194,12 +208,53 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
             )
         )
 
-        advanced = self.costing_options.get_costing_params()
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.IN_BANDS,
+                description="Return non-overlapping bands between consecutive contours (Polygon only)",
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                name=self.IN_PREVIOUS,
+                description="Previous output to update, only new or changed features are requested",
+                types=[QgsProcessing.TypeVectorPolygon, QgsProcessing.TypeVectorLine],
+                optional=True
+            )
+        )
+
+        advanced = [
+            QgsProcessingParameterBoolean(
+                name=self.IN_PRESNAP,
+                description="Snap locations first (once per unique location with /locate)",
+                defaultValue=False
+            ),
+            QgsProcessingParameterNumber(
+                name=self.IN_CACHE_TOLERANCE,
+                description="Share one response between origins in the same grid cell of this size (m), 0 to disable",
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0
+            )
+        ]
+        advanced.extend(self.costing_options.get_costing_params())
 
         for p in advanced:
             p.setFlags(p.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
             self.addParameter(p)
 
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUT_ARROW,
+                description="Isochrones " + self.PROFILE.capitalize() + " as GeoParquet/Arrow",
+                fileFilter=arrow_export.FILE_FILTER,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
         self.addOutput(
             QgsProcessingOutputVectorLayer(
                 name=self.OUT_TIME,
@@ -270,13 +325,21 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
         # Init ORS client
         providers = configmanager.read_config()['providers']
         provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
-        clnt = client.Client(provider)
+        clnt = client.get_client(provider)
+        clnt.warm_up()
         clnt.overQueryLimit.connect(lambda : feedback.reportError("OverQueryLimit: Retrying..."))
 
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/isochrone'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /isochrone.")
+
         params = dict()
 
         geometry_param = self.GEOMETRY_TYPES[self.parameterAsEnum(parameters, self.IN_GEOMETRY, context)]
         params[self.IN_GEOMETRY] = True if geometry_param == 'Polygon' else False
+        bands = self.parameterAsBool(parameters, self.IN_BANDS, context) and geometry_param == 'Polygon'
+        # A band can fall apart into several parts
+        layer_type = 'MultiPolygon' if bands else geometry_param
 
         mode = self.MODE_TYPES[self.parameterAsEnum(parameters, self.IN_MODE, context)]
 
@@ -296,23 +359,23 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
         self.isochrones.set_parameters(self.PROFILE, geometry_param, id_field.type(), id_field_name)
 
         layer_time = QgsVectorLayer(
-            f'{geometry_param}?crs=EPSG:4326',
+            f'{layer_type}?crs=EPSG:4326',
             f'Isochrones {self.PROFILE.capitalize()}',
             'memory'
         )
         self.isos_time_id = layer_time.id()
         layer_time_pr = layer_time.dataProvider()
-        layer_time_pr.addAttributes(self.isochrones.get_fields())
+        layer_time_pr.addAttributes(self.isochrones.get_fields(fingerprint=True))
         layer_time.updateFields()
 
         layer_dist = QgsVectorLayer(
-            f'{geometry_param}?crs=EPSG:4326',
+            f'{layer_type}?crs=EPSG:4326',
             f'Isodistances {self.PROFILE.capitalize()}',
             'memory'
         )
         self.isos_dist_id = layer_dist.id()
         layer_dist_pr = layer_dist.dataProvider()
-        layer_dist_pr.addAttributes(self.isochrones.get_fields())
+        layer_dist_pr.addAttributes(self.isochrones.get_fields(fingerprint=True))
         layer_dist.updateFields()
 
         layer_snapped_points = QgsVectorLayer(
@@ -335,101 +398,201 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
         layer_input_points_pr.addAttributes(self.isochrones.get_point_fields())
         layer_input_points.updateFields()
 
-        denoise = self.parameterAsDouble(parameters, self.IN_DENOISE, context)
-        if denoise:
-            params[self.IN_DENOISE] = denoise
-
-        generalize = self.parameterAsDouble(parameters, self.IN_GENERALIZE, context)
-        if generalize:
-            params[self.IN_GENERALIZE] = generalize
-
-        avoid_layer = self.parameterAsLayer(
-            parameters,
-            self.IN_AVOID,
-            context
-        )
-        if avoid_layer:
-            params['avoid_locations'] = get_avoid_locations(avoid_layer)
-
-        show_locations = self.parameterAsBool(parameters, self.IN_SHOW_LOCATIONS, context)
-
-        # Sets all advanced parameters as attributes of self.costing_options
-        self.costing_options.set_costing_options(self, parameters, context)
-
-        intervals_time = self.parameterAsString(parameters, self.IN_INTERVALS_TIME, context)
-        intervals_distance = self.parameterAsString(parameters, self.IN_INTERVALS_DISTANCE, context)
-
-        feat_count = source.featureCount() if not intervals_time else source.featureCount() * 2
-
-        self.intervals = {
-            "time": [{"time": float(x)} for x in intervals_time.split(',')] if intervals_time else [],
-            "distance": [{"distance": float(x)} for x in intervals_distance.split(',')] if intervals_distance else []
-        }
+        # Time and distance contours go to the same file, told apart by the metric column
+        self.arrow_path = self.parameterAsFileOutput(parameters, self.OUT_ARROW, context)
+        arrow_sink = arrow_export.ArrowSink(
+            self.arrow_path, self.isochrones.get_fields(fingerprint=True)
+        ) if self.arrow_path else None
+        try:
+            denoise = self.parameterAsDouble(parameters, self.IN_DENOISE, context)
+            if denoise:
+                params[self.IN_DENOISE] = denoise
+
+            generalize = self.parameterAsDouble(parameters, self.IN_GENERALIZE, context)
+            if generalize:
+                params[self.IN_GENERALIZE] = generalize
+
+            avoid_layer = self.parameterAsLayer(
+                parameters,
+                self.IN_AVOID,
+                context
+            )
+            if avoid_layer:
+                params['avoid_locations'] = get_avoid_locations(avoid_layer)
+
+            show_locations = self.parameterAsBool(parameters, self.IN_SHOW_LOCATIONS, context)
+
+            # Sets all advanced parameters as attributes of self.costing_options
+            self.costing_options.set_costing_options(self, parameters, context)
+            # Same for every request, serialize it once
+            self.isochrones.set_options(get_costing_options(self.costing_options, self.PROFILE, mode).get(self.PROFILE))
+
+            intervals_time = self.parameterAsString(parameters, self.IN_INTERVALS_TIME, context)
+            intervals_distance = self.parameterAsString(parameters, self.IN_INTERVALS_DISTANCE, context)
+
+            feat_count = source.featureCount() if not intervals_time else source.featureCount() * 2
+
+            self.intervals = {
+                "time": [{"time": float(x)} for x in intervals_time.split(',')] if intervals_time else [],
+                "distance": [{"distance": float(x)} for x in intervals_distance.split(',')] if intervals_distance else []
+            }
+            self._validate_intervals(provider_caps)
+
+            # Collect output features and write them in batches
+            layer_time_pr, layer_dist_pr, layer_snapped_points_pr, layer_input_points_pr = [
+                batching.BatchedSink(layer_pr)
+                for layer_pr in (layer_time_pr, layer_dist_pr, layer_snapped_points_pr, layer_input_points_pr)
+            ]
+
+            # Results of an earlier run by fingerprint, unchanged features are copied forward instead of requested
+            previous = None
+            previous_source = self.parameterAsSource(parameters, self.IN_PREVIOUS, context)
+            if previous_source is not None:
+                previous = fingerprint.get_previous_features(previous_source)
+                if previous is None:
+                    raise QgsProcessingException(
+                        "ParameterError: The previous output has no fingerprint field, it can't be updated."
+                    )
+
+            output_fields = self.isochrones.get_fields(fingerprint=True)
+
+            # Read and transform the input once for all metrics
+            feature_params = list(self.get_sorted_feature_parameters(source, id_field_name))
+            # Fingerprints are taken from the input locations, not the snapped ones
+            input_locations = [locations for locations, _ in feature_params]
+            if self.parameterAsBool(parameters, self.IN_PRESNAP, context) and provider_caps.has_action('/locate'):
+                feedback.pushInfo("Snapping unique locations...")
+                snapped = locate_core.snap_locations(
+                    clnt,
+                    [locations[0] for locations, _ in feature_params],
+                    self.PROFILE,
+                    get_costing_options(self.costing_options, self.PROFILE, mode),
+                    provider_caps.limit(self.PROFILE, 'max_locations') or 20
+                )
+                feature_params = [
+                    (locate_core.apply_snapped(locations, snapped), feat) for locations, feat in feature_params
+                ]
+
+            # Origins in the same grid cell share one response per metric
+            tolerance = self.parameterAsDouble(parameters, self.IN_CACHE_TOLERANCE, context)
+            if tolerance and feature_params:
+                cells = distance.grid_cells([locations[0] for locations, _ in feature_params], tolerance)
+            else:
+                cells = [None] * len(feature_params)
 
-        counter = 0
+            counter = 0
+            reused = 0
+            shared = 0
 
-        for metric, interv in self.intervals.items():
-            if feedback.isCanceled():
-                break
-            if not interv:
-                continue
-            # Make the actual requests
-            requests = []
-            for properties in self.get_sorted_feature_parameters(source):
+            for metric, interv in self.intervals.items():
                 if feedback.isCanceled():
                     break
-                r_params = deepcopy(params)
-                r_params['contours'] = interv
-                # Get transformed coordinates and feature
-                locations, feat = properties
-                r_params.update(get_directions_params(locations, self.PROFILE, self.costing_options, mode))
-                r_params['id'] = feat[id_field_name]
-                requests.append(r_params)
-
-            for params in requests:
-                counter += 1
-                if feedback.isCanceled():
-                    break
-                # If feature causes error, report and continue with next
-                exception: Optional[Exception] = None
-                try:
-                    # Populate features from response
-                    response = clnt.request('/isochrone', post_json=params)
-                except exceptions.ApiError as e:
-                    exception = e
+                if not interv:
                     continue
-                except Exception as e:
-                    exception = e
-                    raise
-                finally:
-                    if exception:
-                        msg = "{}:\n{}".format(
-                            exception.__class__.__name__,
-                            str(exception))
-                        feedback.reportError(msg)
-                        logger.log(msg, 2)
-                        msg = f"Was caused by feature ID {params['id']} with parameters {params}"
-                        feedback.reportError(msg)
-                        logger.log(msg, 2)
-
-                options = {}
-                if params.get('costing_options'):
-                    options = params['costing_options']
-
-                self.isochrones.set_response(response)
-                for isochrone in self.isochrones.get_features(params['id'], options.get(self.PROFILE)):
-                    if metric == 'time':
-                        layer_time_pr.addFeature(isochrone)
-                    elif metric == 'distance':
-                        layer_dist_pr.addFeature(isochrone)
-
-                if show_locations:
-                    for point_feat in self.isochrones.get_multipoint_features(params['id']):
-                        layer_snapped_points_pr.addFeature(point_feat)
-                    for point_feat in self.isochrones.get_point_features(params['id']):
-                        layer_input_points_pr.addFeature(point_feat)
-
-                feedback.setProgress(int((counter / feat_count) * 100))
+                # Make the actual requests
+                requests = []
+                responses = OrderedDict()
+                for properties, fp_locations, cell in zip(feature_params, input_locations, cells):
+                    if feedback.isCanceled():
+                        break
+                    r_params = deepcopy(params)
+                    r_params['contours'] = interv
+                    # Get transformed coordinates and feature
+                    locations, feat = properties
+                    r_params.update(get_directions_params(locations, self.PROFILE, self.costing_options, mode))
+                    r_params['id'] = feat[id_field_name]
+                    # Bands and response sharing aren't request parameters, but change the output
+                    hash_params = dict(r_params)
+                    if bands:
+                        hash_params['bands'] = True
+                    if tolerance:
+                        hash_params['cache_tolerance'] = tolerance
+                    fp = fingerprint.get_fingerprint(
+                        fp_locations,
+                        [r_params['id']],
+                        fingerprint.get_params_hash(hash_params, provider['base_url'])
+                    )
+                    if previous and fp in previous:
+                        counter += 1
+                        reused += 1
+                        for isochrone in fingerprint.copy_features(previous.pop(fp), output_fields):
+                            if metric == 'time':
+                                layer_time_pr.addFeature(isochrone)
+                            elif metric == 'distance':
+                                layer_dist_pr.addFeature(isochrone)
+                            if arrow_sink is not None:
+                                arrow_sink.addFeature(isochrone)
+                        continue
+                    requests.append((r_params, fp, cell))
+
+                for params, fp, cell in requests:
+                    counter += 1
+                    if feedback.isCanceled():
+                        break
+                    # If feature causes error, report and continue with next
+                    exception: Optional[Exception] = None
+                    is_shared = cell in responses
+                    try:
+                        # Populate features from response
+                        if is_shared:
+                            response = responses[cell]
+                            responses.move_to_end(cell)
+                            shared += 1
+                        else:
+                            response = clnt.request('/isochrone', post_json=params)
+                            if cell is not None:
+                                responses[cell] = response
+                                if len(responses) > RESPONSE_CACHE_SIZE:
+                                    responses.popitem(last=False)
+                    except exceptions.ApiError as e:
+                        exception = e
+                        continue
+                    except Exception as e:
+                        exception = e
+                        raise
+                    finally:
+                        if exception:
+                            msg = "{}:\n{}".format(
+                                exception.__class__.__name__,
+                                str(exception))
+                            feedback.reportError(msg)
+                            logger.log(msg, 2)
+                            msg = f"Was caused by feature ID {params['id']} with parameters {params}"
+                            feedback.reportError(msg)
+                            logger.log(msg, 2)
+
+                    self.isochrones.set_response(response)
+                    for isochrone in self.isochrones.get_features(params['id'], metric=metric, fingerprint=fp, bands=bands):
+                        if metric == 'time':
+                            layer_time_pr.addFeature(isochrone)
+                        elif metric == 'distance':
+                            layer_dist_pr.addFeature(isochrone)
+                        if arrow_sink is not None:
+                            arrow_sink.addFeature(isochrone)
+
+                    if show_locations and is_shared:
+                        # The response's locations are another origin's, only this feature's input location is known
+                        location = QgsPointXY(params['locations'][0]['lon'], params['locations'][0]['lat'])
+                        for point_feat in self.isochrones.get_point_features(params['id'], location):
+                            layer_input_points_pr.addFeature(point_feat)
+                    elif show_locations:
+                        for point_feat in self.isochrones.get_multipoint_features(params['id']):
+                            layer_snapped_points_pr.addFeature(point_feat)
+                        for point_feat in self.isochrones.get_point_features(params['id']):
+                            layer_input_points_pr.addFeature(point_feat)
+
+                    feedback.setProgress(int((counter / feat_count) * 100))
+
+            for layer_pr in (layer_time_pr, layer_dist_pr, layer_snapped_points_pr, layer_input_points_pr):
+                layer_pr.flush()
+            if previous is not None:
+                feedback.pushInfo(f"Reused {reused} unchanged results from the previous output.")
+            if tolerance:
+                feedback.pushInfo(f"{shared} requests were answered by the response of a nearby origin.")
+        finally:
+            # Finalize the file also if the run fails or is canceled
+            if arrow_sink is not None:
+                arrow_sink.close()
 
         temp = []
         if layer_time.hasFeatures():
@@ -450,6 +613,8 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
             temp.append(("Input Points " + self.PROFILE.capitalize(), self.POINTS_INPUT, layer_input_points.id()))
 
         results = dict()
+        if arrow_sink is not None:
+            results[self.OUT_ARROW] = self.arrow_path
         for l_name, e_id, l_id in temp:
             results[e_id] = l_id
             context.addLayerToLoadOnCompletion(
@@ -458,6 +623,8 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
                                                   context.project(),
                                                   l_name))
 
+        logger.flush()
+
         return results
 
     def postProcessAlgorithm(self, context, feedback):
@@ -475,21 +642,48 @@ class ValhallaIsochronesCarAlgo(QgsProcessingAlgorithm):
             if processed_layer:
                 # self.isochrones.stylePoly(processed_layer, metric)
                 result[out_id] = layer_id
+        if self.arrow_path:
+            result[self.OUT_ARROW] = self.arrow_path
 
         return result
 
-    def get_sorted_feature_parameters(self, layer):
+    def _validate_intervals(self, provider_caps):
+        """
+        Raises before any request is made if the intervals exceed the provider's isochrone limits.
+
+        :param provider_caps: the provider's capabilities
+        :type provider_caps: valhalla.common.capabilities.Capabilities
+        """
+        max_contours = provider_caps.limit('isochrone', 'max_contours')
+        max_values = {
+            'time': provider_caps.limit('isochrone', 'max_time_contour'),
+            'distance': provider_caps.limit('isochrone', 'max_distance_contour')
+        }
+        for metric, interv in self.intervals.items():
+            if max_contours and len(interv) > max_contours:
+                raise QgsProcessingException(
+                    f"ParameterError: The provider allows at most {max_contours} {metric} intervals, got {len(interv)}."
+                )
+            max_value = max_values[metric]
+            if max_value and any(contour[metric] > max_value for contour in interv):
+                raise QgsProcessingException(
+                    f"ParameterError: The provider allows {metric} intervals up to {max_value}."
+                )
+
+    def get_sorted_feature_parameters(self, layer, id_field_name):
         """
         Generator to yield geometry and id of features sorted by feature ID. Careful: feat.id() is not necessarily
         permanent
 
         :param layer: source input layer.
         :type layer: QgsProcessingParameterFeatureSource
-        """
-        # First get coordinate transformer
-        xformer = transform.transformToWGS(layer.sourceCrs())
 
-        for feat in sorted(layer.getFeatures(), key=lambda f: f.id()):
-            x_point = xformer.transform(feat.geometry().asPoint())
+        :param id_field_name: name of the ID field, the only attribute fetched.
+        :type id_field_name: str
+        """
+        feats = list(features.get_features(layer, [id_field_name]))
+        # Transform all points at once
+        points = transform.transform_points([feat.geometry().asPoint() for feat in feats], layer.sourceCrs())
 
+        for x_point, feat in zip(points, feats):
             yield ([x_point], feat)
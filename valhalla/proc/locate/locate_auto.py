@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os.path
+from functools import partial
+
+from PyQt5.QtGui import QIcon
+
+from qgis.core import (QgsWkbTypes,
+                       QgsCoordinateReferenceSystem,
+                       QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingException,
+                       )
+from .. import HELP_DIR
+from ... import RESOURCE_PREFIX, __help__
+from ...common import client, capabilities, locate_core
+from ...utils import configmanager, transform, exceptions, logger, batching, features, concurrency
+from ..costing_params import CostingAuto
+from ..request_builder import get_locations, get_costing_options
+
+
+class ValhallaLocateCarAlgo(QgsProcessingAlgorithm):
+    """Algorithm class for batch snapping with /locate."""
+
+    ALGO_NAME = 'locate_auto'
+    ALGO_NAME_LIST = ALGO_NAME.split('_')
+
+    HELP = 'algorithm_locate.help'
+
+    COSTING = CostingAuto
+    PROFILE = 'auto'
+
+    IN_PROVIDER = "INPUT_PROVIDER"
+    IN_POINTS = "INPUT_POINT_LAYER"
+    IN_FIELD = "INPUT_FIELD"
+    IN_RADIUS = "INPUT_RADIUS"
+    OUT = 'OUTPUT'
+
+    def __init__(self):
+        super(ValhallaLocateCarAlgo, self).__init__()
+        self.providers = configmanager.read_config()['providers']
+        self.costing_options = self.COSTING()
+
+    def initAlgorithm(self, configuration, p_str=None, Any=None, *args, **kwargs):
+
+        providers = [provider['name'] for provider in self.providers]
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.IN_PROVIDER,
+                "Provider",
+                providers,
+                defaultValue=providers[0]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                name=self.IN_POINTS,
+                description="Input Point layer",
+                types=[QgsProcessing.TypeVectorPoint],
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterField(
+                name=self.IN_FIELD,
+                description="Layer ID Field",
+                parentLayerParameterName=self.IN_POINTS,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.IN_RADIUS,
+                description="Search radius [m] (0: server default)",
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0
+            )
+        )
+
+        advanced = self.costing_options.get_costing_params()
+
+        for p in advanced:
+            p.setFlags(p.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+            self.addParameter(p)
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                name=self.OUT,
+                description="Snapped Points " + self.PROFILE.capitalize(),
+            )
+        )
+
+    def group(self):
+        return self.PROFILE.capitalize()
+
+    def groupId(self):
+        return self.PROFILE
+
+    def name(self):
+        return self.ALGO_NAME
+
+    def shortHelpString(self):
+        """Displays the sidebar help in the algorithm window"""
+
+        file = os.path.join(
+            HELP_DIR,
+            self.HELP
+        )
+        with open(file) as helpf:
+            msg = helpf.read()
+
+        return msg
+
+    def helpUrl(self):
+        """will be connected to the Help button in the Algorithm window"""
+        return __help__
+
+    def displayName(self):
+        return " ".join(map(lambda x: x.capitalize(), self.ALGO_NAME_LIST))
+
+    def icon(self):
+        return QIcon(RESOURCE_PREFIX + 'icon_locate.png')
+
+    def createInstance(self):
+        return ValhallaLocateCarAlgo()
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        # Init client
+        providers = configmanager.read_config()['providers']
+        provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
+        clnt = client.get_client(provider)
+        clnt.warm_up()
+
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/locate'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /locate.")
+        # Pack as many locations into a request as the server accepts
+        batch_size = provider_caps.limit(self.PROFILE, 'max_locations') or 20
+
+        # Get parameter values
+        source = self.parameterAsSource(parameters, self.IN_POINTS, context)
+        if source.wkbType() == QgsWkbTypes.MultiPoint:
+            raise QgsProcessingException("TypeError: Multipoint Layers are not accepted. Please convert to single geometry layer.")
+        id_field_name = self.parameterAsString(parameters, self.IN_FIELD, context)
+        radius = self.parameterAsInt(parameters, self.IN_RADIUS, context)
+
+        # Sets all advanced parameters as attributes of self.costing_options
+        self.costing_options.set_costing_options(self, parameters, context)
+
+        params = dict(
+            costing=self.PROFILE,
+            verbose=True
+        )
+        costing_params = get_costing_options(self.costing_options, self.PROFILE, 'Fastest')
+        if costing_params:
+            params['costing_options'] = costing_params
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUT, context,
+                                               locate_core.get_fields(source.fields().field(id_field_name).type(),
+                                                                      id_field_name),
+                                               QgsWkbTypes.Point,
+                                               QgsCoordinateReferenceSystem(4326))
+        sink = batching.BatchedSink(sink)
+
+        def get_requests():
+            """Builds the requests lazily, so only the batches in flight are held in memory."""
+            for num, (id_values, points) in enumerate(self._get_batches(source, id_field_name, batch_size)):
+                locations = get_locations(points)
+                if radius:
+                    for location in locations:
+                        location['radius'] = radius
+                r_params = dict(params, locations=locations, id=num)
+
+                yield r_params, id_values, points
+
+        count = source.featureCount()
+        counter = 0
+        unsnapped = 0
+        for (r_params, id_values, points), future in concurrency.ordered_map(partial(self._locate, provider),
+                                                                           get_requests()):
+            # Stop the algorithm if cancel button has been clicked
+            if feedback.isCanceled():
+                break
+
+            counter += len(points)
+            try:
+                response = future.result()
+            except (exceptions.ApiError,
+                    exceptions.Timeout,
+                    exceptions.OverQueryLimit,
+                    exceptions.GenericServerError) as e:
+                # An unreachable host fails every batch
+                if isinstance(e, exceptions.GenericServerError) and e.status == 1:
+                    logger.log("{}:\n{}".format(e.__class__.__name__, str(e)), 2)
+                    raise
+                msg = "Feature IDs {} caused a {}:\n{}".format(
+                    ', '.join(map(str, id_values)),
+                    e.__class__.__name__,
+                    str(e))
+                feedback.reportError(msg)
+                logger.log(msg, 1)
+                continue
+
+            except exceptions.InvalidKey as e:
+                msg = "{}:\n{}".format(
+                    e.__class__.__name__,
+                    str(e))
+                logger.log(msg, 2)
+                raise
+
+            for feat in locate_core.get_output_features(response, id_values, points):
+                if not feat.hasGeometry():
+                    unsnapped += 1
+                sink.addFeature(feat)
+
+            feedback.setProgress(int(100.0 / count * counter))
+
+        sink.flush()
+        if unsnapped:
+            feedback.reportError(f"{unsnapped} locations couldn't be snapped to the graph, their attributes are NULL.")
+
+        logger.flush()
+
+        return {self.OUT: dest_id}
+
+    @staticmethod
+    def _locate(provider, request):
+        """
+        Snaps one batch of locations. Runs in a worker thread, which gets its own client.
+
+        :param provider: provider settings from config.yml
+        :type provider: dict
+
+        :param request: locate parameters, ID values and points of the batch, see get_requests()
+        :type request: tuple
+
+        :returns: locate response
+        :rtype: list of dict
+        """
+        return client.get_client(provider).request('/locate', post_json=request[0])
+
+    @staticmethod
+    def _get_batches(layer, field_name, batch_size):
+        """
+        Generator to yield ID values and WGS84 points of the features in batches, sorted by feature ID.
+
+        :param layer: source input layer
+        :type layer: QgsProcessingParameterFeatureSource
+
+        :param field_name: name of ID field
+        :type field_name: str
+
+        :param batch_size: number of features per batch
+        :type batch_size: int
+        """
+        crs = layer.sourceCrs()
+        feats = list()
+        for feat in features.get_features(layer, [field_name]):
+            feats.append(feat)
+            if len(feats) == batch_size:
+                yield [f[field_name] for f in feats], transform.transform_points([f.geometry().asPoint() for f in feats], crs)
+                feats = list()
+        if feats:
+            yield [f[field_name] for f in feats], transform.transform_points([f.geometry().asPoint() for f in feats], crs)
@@ -24,8 +24,11 @@
  ***************************************************************************/
 """
 
+import json
 import os.path
 
+import numpy as np
+
 from PyQt5.QtGui import QIcon
 
 from qgis.core import (QgsWkbTypes,
@@ -39,14 +42,35 @@ from qgis.core import (QgsWkbTypes,
                        QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterDefinition,
                        QgsProcessingParameterMapLayer,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingUtils,
                        )
 from .. import HELP_DIR
 from ... import RESOURCE_PREFIX, __help__
-from ...common import client, matrix_core
-from ...utils import configmanager, transform, exceptions, logger
+from ...common import client, capabilities, matrix_core
+from ...utils import configmanager, distance, transform, exceptions, logger, arrow_export, batching, features
 from ..costing_params import CostingAuto
 from ..request_builder import get_locations, get_costing_options, get_avoid_locations
 
+# Valhalla error codes caused by single locations or pairs (too far apart, no edges nearby, unconnected or
+# unreachable), the only errors a block is bisected for
+LOCATION_ERROR_CODES = {154, 170, 171, 172} | set(range(440, 450))
+
+
+def _is_location_error(error):
+    """
+    :param error: The error a request caused.
+    :type error: valhalla.utils.exceptions.ApiError
+
+    :returns: whether the error is caused by the locations rather than the request as a whole
+    :rtype: bool
+    """
+    try:
+        return int(error.error_code) in LOCATION_ERROR_CODES
+    except (TypeError, ValueError):
+        return False
+
 
 class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
 
@@ -58,6 +82,7 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
     COSTING = CostingAuto
     PROFILE = 'auto'
     MODE_TYPES = ['Fastest', 'Shortest']
+    FORMAT_TYPES = ['Long', 'Wide']
 
     IN_PROVIDER = "INPUT_PROVIDER"
     IN_START = "INPUT_START_LAYER"
@@ -66,13 +91,27 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
     IN_END_FIELD = "INPUT_END_FIELD"
     IN_MODE = "INPUT_MODE"
     IN_AVOID = "avoid_locations"
+    IN_MEMMAP = "INPUT_MEMMAP"
+    IN_FORMAT = "INPUT_FORMAT"
     OUT = 'OUTPUT'
+    OUT_ARRAYS = 'OUTPUT_ARRAYS'
+    OUT_ARROW = 'OUTPUT_ARROW'
 
     def __init__(self):
         super(ValhallaMatrixCarAlgo, self).__init__()
         self.providers = configmanager.read_config()['providers']
         self.costing_options = self.COSTING()
 
+        # Per-run state for requesting and bisecting blocks, set in processAlgorithm
+        self.points = None
+        self.attributes = None
+        self.unroutable = None
+        self.routable = None
+        self.store = None
+        self.write_features = True
+        self.wide_dest_id = None
+        self.wide_options = None
+
     def initAlgorithm(self, configuration, p_str=None, Any=None, *args, **kwargs):
 
         providers = [provider['name'] for provider in self.providers]
@@ -141,14 +180,52 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
             p.setFlags(p.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
             self.addParameter(p)
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.IN_FORMAT,
+                'Output format (Wide: one row per source, one duration & distance column per target)',
+                options=self.FORMAT_TYPES,
+                defaultValue=self.FORMAT_TYPES[0]
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 name=self.OUT,
                 description="Matrix " + self.PROFILE.capitalize(),
+                optional=True,
+                createByDefault=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUT_ARROW,
+                description="Matrix " + self.PROFILE.capitalize() + " as Parquet/Arrow",
+                fileFilter=arrow_export.FILE_FILTER,
+                optional=True,
                 createByDefault=False
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUT_ARRAYS,
+                description="Matrix " + self.PROFILE.capitalize() + " as NumPy arrays",
+                fileFilter="NumPy archive (*.npz)",
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        memmap = QgsProcessingParameterBoolean(
+            name=self.IN_MEMMAP,
+            description="Memory-map NumPy arrays (writes .npy files instead of .npz, for very large matrices)",
+            defaultValue=False
+        )
+        memmap.setFlags(memmap.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(memmap)
+
     def group(self):
         return self.PROFILE.capitalize()
 
@@ -188,9 +265,16 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
         # Init ORS client
         providers = configmanager.read_config()['providers']
         provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
-        clnt = client.Client(provider)
+        clnt = client.get_client(provider)
+        clnt.warm_up()
         clnt.overQueryLimit.connect(lambda: feedback.reportError("OverQueryLimit: Retrying"))
 
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/sources_to_targets'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /sources_to_targets.")
+        # Block size, so that sources x targets stays within the server's max_matrix_location_pairs
+        chunk_size = provider_caps.matrix_chunk_size(self.PROFILE)
+
         mode = self.MODE_TYPES[self.parameterAsEnum(parameters, self.IN_MODE, context)]
 
         # Get parameter values
@@ -227,17 +311,6 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
         destination_field_id = destination.fields().lookupField(destination_field_name)
         destination_field = destination.fields().field(destination_field_id)
 
-        (sink, dest_id) = self.parameterAsSink(
-            parameters,
-            self.OUT,
-            context,
-            matrix_core.get_fields(
-                source_field.type(),
-                destination_field.type()
-            ),
-            QgsWkbTypes.NoGeometry
-        )
-
         # Abort when MultiPoint type
         if (source.wkbType() or destination.wkbType()) == 4:
             raise QgsProcessingException("TypeError: Multipoint Layers are not accepted. Please convert to single geometry layer.")
@@ -250,14 +323,18 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
                 "ProcessingError: Too large input, please decimate."
             )
 
-        sources_features = list(source.getFeatures())
-        destinations_features = list(destination.getFeatures())
+        sources_features = list(features.get_features(source, [source_field_name], sort=False))
+        destinations_features = list(features.get_features(destination, [destination_field_name], sort=False))
 
         # Get source and destination features
-        xformer_source = transform.transformToWGS(source.sourceCrs())
-        sources_points = [xformer_source.transform(feat.geometry().asPoint()) for feat in sources_features]
-        xformer_destination = transform.transformToWGS(destination.sourceCrs())
-        destination_points = [xformer_destination.transform(feat.geometry().asPoint()) for feat in destinations_features]
+        sources_points = transform.transform_points(
+            [feat.geometry().asPoint() for feat in sources_features],
+            source.sourceCrs()
+        )
+        destination_points = transform.transform_points(
+            [feat.geometry().asPoint() for feat in destinations_features],
+            destination.sourceCrs()
+        )
 
         # Build params
         params = dict(
@@ -277,47 +354,305 @@ class ValhallaMatrixCarAlgo(QgsProcessingAlgorithm):
         sources_attributes = [feat.attribute(source_field_name) for feat in sources_features]
         destinations_attributes = [feat.attribute(destination_field_name) for feat in destinations_features]
 
-        source_attr_iter = self._chunks(sources_attributes, 50)
-        for sources in self._chunks(sources_points, 50):
-            params["sources"] = get_locations(sources)
-            source_attributes = next(source_attr_iter)
-
-            destination_attr_iter = self._chunks(destinations_attributes, 50)
-            for destinations in self._chunks(destination_points, 50):
-                params["targets"] = get_locations(destinations)
-                params["id"] = "matrix"
-                destination_attributes = next(destination_attr_iter)
-
-                # Make request and catch ApiError
-                try:
-                    response = clnt.request('/sources_to_targets', post_json=params)
-                except (exceptions.ApiError) as e:
-                    msg = "{}: {}".format(
-                        e.__class__.__name__,
-                        str(e))
-                    feedback.reportError(msg)
-                    logger.log(msg)
-                    continue
-                except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
-                    msg = "{}:\n{}".format(
-                        e.__class__.__name__,
-                        str(e))
-                    logger.log(msg)
-                    raise
-
-                feats = matrix_core.get_output_features_matrix(
-                    response,
-                    self.PROFILE,
-                    costing_params,
-                    False,
-                    source_attributes,
-                    destination_attributes
+        # Reset the per-run state used while requesting blocks
+        self.points = {'sources': sources_points, 'targets': destination_points}
+        self.attributes = {'sources': sources_attributes, 'targets': destinations_attributes}
+        self.unroutable = {'sources': set(), 'targets': set()}
+        self.routable = {'sources': set(), 'targets': set()}
+
+        wide = self.FORMAT_TYPES[self.parameterAsEnum(parameters, self.IN_FORMAT, context)] == 'Wide'
+        if wide:
+            # Shapefiles truncate field names to 10 characters, the per-target columns wouldn't be unique anymore
+            if (self.parameterAsOutputLayer(parameters, self.OUT, context) or '').lower().endswith('.shp'):
+                raise QgsProcessingException(
+                    "ParameterError: The wide format can't be written to a Shapefile. Use another output format "
+                    "or the long format instead."
                 )
+            if len(destinations_attributes) > matrix_core.MAX_WIDE_TARGETS:
+                raise QgsProcessingException(
+                    f"ParameterError: The wide format allows at most {matrix_core.MAX_WIDE_TARGETS} destinations, "
+                    f"got {len(destinations_attributes)}. Use the long format instead."
+                )
+            fields = matrix_core.get_wide_fields(source_field.type(), destinations_attributes)
+        else:
+            fields = matrix_core.get_fields(source_field.type(), destination_field.type())
 
-                for feat in feats:
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            self.OUT,
+            context,
+            fields,
+            QgsWkbTypes.NoGeometry
+        )
+        arrow_path = self.parameterAsFileOutput(parameters, self.OUT_ARROW, context)
+        (sink, arrow_sink) = arrow_export.get_sink(arrow_path, fields, sink, geometry=False)
+        try:
+            arrays_path = self.parameterAsFileOutput(parameters, self.OUT_ARRAYS, context)
+            if sink is None and not arrays_path:
+                raise QgsProcessingException("ParameterError: Please set at least one of the outputs.")
+            self.write_features = sink is not None and not wide
+            if sink is not None:
+                sink = batching.BatchedSink(sink)
+
+            # Wide rows can only be written once all blocks of a source are done, so collect them in the store
+            self.store = None
+            if arrays_path or (wide and sink is not None):
+                self.store = matrix_core.MatrixStore(
+                    sources_attributes,
+                    destinations_attributes,
+                    arrays_path,
+                    self.parameterAsBool(parameters, self.IN_MEMMAP, context)
+                )
+
+            max_matrix_distance = provider_caps.limit(self.PROFILE, 'max_matrix_distance')
+
+            for sources in self._chunks(list(range(len(sources_points))), chunk_size):
+                if feedback.isCanceled():
+                    break
+                for destinations in self._chunks(list(range(len(destination_points))), chunk_size):
+                    if feedback.isCanceled():
+                        break
+
+                    valid = np.ones((len(sources), len(destinations)), dtype=bool)
+                    if max_matrix_distance:
+                        # A single pair beyond max_matrix_distance fails the whole block, so request them separately
+                        valid = distance.haversine_matrix(
+                            [sources_points[i] for i in sources],
+                            [destination_points[i] for i in destinations]
+                        ) <= max_matrix_distance
+                        if not valid.all():
+                            feedback.reportError(
+                                f"{int((~valid).sum())} pairs are further apart than the provider's max_matrix_distance "
+                                f"of {max_matrix_distance} m, their results are NULL."
+                            )
+                    # Don't request locations which failed in previous blocks again
+                    valid[[i in self.unroutable['sources'] for i in sources], :] = False
+                    valid[:, [i in self.unroutable['targets'] for i in destinations]] = False
+
+                    blocks, invalid_pairs = matrix_core.split_matrix_block(valid)
+                    for s, d in invalid_pairs if self.write_features else []:
+                        sink.addFeature(matrix_core.get_null_feature_matrix(
+                            sources_attributes[sources[s]],
+                            destinations_attributes[destinations[d]],
+                            self.PROFILE,
+                            costing_params
+                        ))
+
+                    for source_idx, destination_idx in blocks:
+                        feats = self._request_block(
+                            clnt,
+                            params,
+                            [sources[i] for i in source_idx],
+                            [destinations[i] for i in destination_idx],
+                            costing_params,
+                            feedback
+                        )
+
+                        for feat in feats:
+                            sink.addFeature(feat)
+
+            self.wide_dest_id = None
+            if wide and sink is not None:
+                for feat in matrix_core.get_output_features_wide(self.store):
                     sink.addFeature(feat)
+                # PROFILE and OPTIONS go to the layer metadata in postProcessAlgorithm
+                self.wide_dest_id = dest_id
+                self.wide_options = costing_params
+
+            if sink is not None:
+                sink.flush()
+        finally:
+            # Finalize the file also if the run fails or is canceled
+            if arrow_sink is not None:
+                arrow_sink.close()
+
+        results = {self.OUT: dest_id}
+        if arrow_sink is not None:
+            results[self.OUT_ARROW] = arrow_path
+        if arrays_path:
+            for path in self.store.save():
+                feedback.pushInfo(f"Wrote {path}")
+            results[self.OUT_ARRAYS] = arrays_path
+
+        logger.flush()
+
+        return results
+
+    def postProcessAlgorithm(self, context, feedback):
+        """Store the constant PROFILE and OPTIONS of the wide output once in its layer metadata."""
+        if self.wide_dest_id:
+            layer = QgsProcessingUtils.mapLayerFromString(self.wide_dest_id, context)
+            if layer:
+                metadata = layer.metadata()
+                metadata.setTitle("Matrix " + self.PROFILE.capitalize())
+                metadata.setAbstract(f"PROFILE: {self.PROFILE}\nOPTIONS: {json.dumps(self.wide_options)}")
+                metadata.addKeywords('valhalla', [f"profile={self.PROFILE}"])
+                layer.setMetadata(metadata)
+                # Persists for file/DB based outputs, no-op for memory layers
+                layer.saveDefaultMetadata()
+
+        return dict()
+
+    def _request_block(self, clnt, params, sources, destinations, costing_params, feedback):
+        """
+        Requests a single block of sources and targets. If the block fails because of its locations, it's bisected
+        until the offending sources, targets or pairs are isolated, so that only their cells are NULL. Blocks failing
+        for other reasons are reported and skipped.
+
+        :param clnt: the provider's client
+        :type clnt: valhalla.common.client.Client
+
+        :param params: request parameters without sources and targets
+        :type params: dict
+
+        :param sources: indices of the source points
+        :type sources: list of int
+
+        :param destinations: indices of the target points
+        :type destinations: list of int
+
+        :param costing_params: costing options used
+        :type costing_params: dict
+
+        :returns: output features
+        :rtype: list of QgsFeature
+        """
+        source_attributes = [self.attributes['sources'][i] for i in sources]
+        destination_attributes = [self.attributes['targets'][i] for i in destinations]
+
+        params["sources"] = get_locations([self.points['sources'][i] for i in sources])
+        params["targets"] = get_locations([self.points['targets'][i] for i in destinations])
+        params["id"] = "matrix"
+
+        # Make request and catch ApiError
+        try:
+            response = clnt.request('/sources_to_targets', post_json=params)
+        except (exceptions.ApiError) as e:
+            logger.log("Block of {} sources and {} targets caused a {}: {}", 0, len(sources), len(destinations),
+                       e.__class__.__name__, e)
+            if not _is_location_error(e):
+                # Not caused by single locations, so requesting them on their own won't help: skip the block
+                msg = "Block of {} sources and {} targets is skipped, it caused a {}:\n{}".format(
+                    len(sources),
+                    len(destinations),
+                    e.__class__.__name__,
+                    str(e))
+                feedback.reportError(msg)
+                logger.log(msg, 1)
+                return []
+            return self._bisect_block(clnt, params, sources, destinations, costing_params, feedback, e)
+        except (exceptions.InvalidKey, exceptions.GenericServerError) as e:
+            msg = "{}:\n{}".format(
+                e.__class__.__name__,
+                str(e))
+            logger.log(msg, 2)
+            raise
+
+        if self.store is not None:
+            self.store.add_response(response, sources, destinations)
+        if not self.write_features:
+            return []
+
+        return matrix_core.get_output_features_matrix(
+            response,
+            self.PROFILE,
+            costing_params,
+            False,
+            source_attributes,
+            destination_attributes
+        )
 
-        return {self.OUT: dest_id}
+    def _bisect_block(self, clnt, params, sources, destinations, costing_params, feedback, error):
+        """
+        Recovers from a failed block: a single source or target is probed on its own and its whole row or column
+        is NULL if it can't be routed; larger blocks are split in half along the longer side.
+
+        :param error: The error the block caused.
+        :type error: valhalla.utils.exceptions.ApiError
+
+        :returns: output features
+        :rtype: list of QgsFeature
+        """
+        def null_features(source_idx, destination_idx):
+            if not self.write_features:
+                return []
+            return [
+                matrix_core.get_null_feature_matrix(
+                    self.attributes['sources'][s],
+                    self.attributes['targets'][d],
+                    self.PROFILE,
+                    costing_params
+                ) for s in source_idx for d in destination_idx
+            ]
+
+        if len(sources) == 1 and not self._is_routable(clnt, params, 'sources', sources[0], feedback):
+            return null_features(sources, destinations)
+        if len(destinations) == 1 and not self._is_routable(clnt, params, 'targets', destinations[0], feedback):
+            return null_features(sources, destinations)
+        if len(sources) == 1 and len(destinations) == 1:
+            msg = "Route from {} to {} caused a {}:\n{}".format(
+                self.attributes['sources'][sources[0]],
+                self.attributes['targets'][destinations[0]],
+                error.__class__.__name__,
+                str(error))
+            feedback.reportError(msg)
+            logger.log(msg, 1)
+            return null_features(sources, destinations)
+
+        if len(sources) >= len(destinations):
+            half = len(sources) // 2
+            halves = [(sources[:half], destinations), (sources[half:], destinations)]
+        else:
+            half = len(destinations) // 2
+            halves = [(sources, destinations[:half]), (sources, destinations[half:])]
+
+        feats = []
+        for source_idx, destination_idx in halves:
+            feats.extend(self._request_block(clnt, params, source_idx, destination_idx, costing_params, feedback))
+
+        return feats
+
+    def _is_routable(self, clnt, params, kind, idx, feedback):
+        """
+        Probes a single location by requesting a matrix from itself to itself, which only fails if the location
+        itself is the problem. Results are remembered for the rest of the run and unroutable locations are reported
+        once.
+
+        :param kind: 'sources' or 'targets'
+        :type kind: str
+
+        :param idx: index of the location
+        :type idx: int
+
+        :rtype: bool
+        """
+        if idx in self.unroutable[kind]:
+            return False
+        if idx in self.routable[kind]:
+            return True
+
+        locations = get_locations([self.points[kind][idx]])
+        probe_params = dict(params, sources=locations, targets=locations, id="matrix_probe")
+        try:
+            clnt.request('/sources_to_targets', post_json=probe_params)
+        except exceptions.ApiError as e:
+            if not _is_location_error(e):
+                # Says nothing about the location, the block is bisected further
+                logger.log("Probing {} {} caused a {}: {}", 0, kind, self.attributes[kind][idx],
+                           e.__class__.__name__, e)
+                return True
+            self.unroutable[kind].add(idx)
+            msg = "{} {} can't be routed, all its results are NULL. {}:\n{}".format(
+                'Source' if kind == 'sources' else 'Target',
+                self.attributes[kind][idx],
+                e.__class__.__name__,
+                str(e))
+            feedback.reportError(msg)
+            logger.log(msg, 1)
+            return False
+
+        self.routable[kind].add(idx)
+        return True
 
     @staticmethod
     def _chunks(l, n):
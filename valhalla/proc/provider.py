@@ -48,6 +48,14 @@ from .matrix.matrix_auto import ValhallaMatrixCarAlgo
 from .matrix.matrix_truck import ValhallaMatrixTruckAlgo
 from .matrix.matrix_bicycle import ValhallaMatrixBicycleAlgo
 from .matrix.matrix_pedestrian import ValhallaMatrixPedestrianAlgo
+from .trace_attributes.trace_attributes_auto import ValhallaTraceAttributesCarAlgo
+from .trace_attributes.trace_attributes_truck import ValhallaTraceAttributesTruckAlgo
+from .trace_attributes.trace_attributes_bicycle import ValhallaTraceAttributesBicycleAlgo
+from .trace_attributes.trace_attributes_pedestrian import ValhallaTraceAttributesPedestrianAlgo
+from .locate.locate_auto import ValhallaLocateCarAlgo
+from .locate.locate_truck import ValhallaLocateTruckAlgo
+from .locate.locate_bicycle import ValhallaLocateBicycleAlgo
+from .locate.locate_pedestrian import ValhallaLocatePedestrianAlgo
 
 
 class ValhallaProvider(QgsProcessingProvider):
@@ -77,6 +85,14 @@ class ValhallaProvider(QgsProcessingProvider):
             ValhallaMatrixTruckAlgo(),
             ValhallaMatrixBicycleAlgo(),
             ValhallaMatrixPedestrianAlgo(),
+            ValhallaTraceAttributesCarAlgo(),
+            ValhallaTraceAttributesTruckAlgo(),
+            ValhallaTraceAttributesBicycleAlgo(),
+            ValhallaTraceAttributesPedestrianAlgo(),
+            ValhallaLocateCarAlgo(),
+            ValhallaLocateTruckAlgo(),
+            ValhallaLocateBicycleAlgo(),
+            ValhallaLocatePedestrianAlgo(),
         ]
 
     def unload(self):
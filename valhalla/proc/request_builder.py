@@ -25,9 +25,9 @@
 """
 import inspect
 
-from qgis.core import QgsPointXY, QgsWkbTypes
+from qgis.core import QgsWkbTypes
 
-from ..utils import transform
+from ..utils import transform, features, convert
 from ..common import TRUCK_COSTING
 from .costing_params import CostingAuto
 
@@ -63,6 +63,43 @@ def get_directions_params(points, profile, costing_options, mode):
 
     return params
 
+
+def get_trace_params(points, profile, costing_options, mode, shape_match='map_snap'):
+    """
+    Get the /trace_attributes parameters for one track, with the shape as encoded polyline.
+
+    :param points: track points in WGS84
+    :type points: list of QgsPointXY
+
+    :param profile: transportation profile
+    :type profile: str
+
+    :param costing_options: costing options class with costing options as attributes
+    :type costing_options: CostingAuto
+
+    :param mode: fastest or shortest
+    :type mode: str
+
+    :param shape_match: Valhalla's shape_match parameter
+    :type shape_match: str
+
+    :returns: dict of Valhalla trace_attributes parameters
+    :rtype: dict
+    """
+    params = dict(
+        costing=profile,
+        shape_match=shape_match,
+        encoded_polyline=convert.encode_polyline6([(point.y(), point.x()) for point in points])
+    )
+
+    costing_params = get_costing_options(costing_options, profile, mode)
+
+    if costing_params:
+        params['costing_options'] = costing_params
+
+    return params
+
+
 def get_locations(points):
     """
     Get the locations parameter value.
@@ -121,11 +158,11 @@ def get_avoid_locations(avoid_layer):
     """
 
     locations = []
-    xformer_avoid = transform.transformToWGS(avoid_layer.sourceCrs())
     if avoid_layer.wkbType() != QgsWkbTypes.MultiPoint:
-        points = []
-        for feat in avoid_layer.getFeatures():
-            points.append(xformer_avoid.transform(QgsPointXY(feat.geometry().asPoint())))
+        points = transform.transform_points(
+            [feat.geometry().asPoint() for feat in features.get_features(avoid_layer, sort=False)],
+            avoid_layer.sourceCrs()
+        )
 
         for point in points:
             locations.append({"lon": round(point.x(), 6), "lat": round(point.y(), 6)})
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os.path
+from functools import partial
+from itertools import groupby
+
+from PyQt5.QtGui import QIcon
+
+from qgis.core import (QgsWkbTypes,
+                       QgsCoordinateReferenceSystem,
+                       QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingException,
+                       )
+from .. import HELP_DIR
+from ... import RESOURCE_PREFIX, __help__
+from ...common import client, capabilities, trace_attributes_core
+from ...utils import configmanager, transform, exceptions, logger, batching, features, concurrency
+from ..costing_params import CostingAuto
+from ..request_builder import get_trace_params
+
+
+class ValhallaTraceAttributesCarAlgo(QgsProcessingAlgorithm):
+    """Algorithm class for batch map matching with /trace_attributes."""
+
+    ALGO_NAME = 'trace_attributes_auto'
+    ALGO_NAME_LIST = ALGO_NAME.split('_')
+
+    HELP = 'algorithm_trace_attributes.help'
+
+    COSTING = CostingAuto
+    PROFILE = 'auto'
+    MODE_TYPES = ['Fastest', 'Shortest']
+    SHAPE_MATCH_TYPES = ['map_snap', 'walk_or_snap', 'edge_walk']
+    ATTRIBUTE_TYPES = list(trace_attributes_core.EXTRA_EDGE_ATTRIBUTES)
+
+    IN_PROVIDER = "INPUT_PROVIDER"
+    IN_TRACKS = "INPUT_TRACK_LAYER"
+    IN_TRACK_FIELD = "INPUT_TRACK_FIELD"
+    IN_ORDER_FIELD = "INPUT_ORDER_FIELD"
+    IN_MODE = "INPUT_MODE"
+    IN_SHAPE_MATCH = "INPUT_SHAPE_MATCH"
+    IN_WINDOW_SIZE = "INPUT_WINDOW_SIZE"
+    IN_WINDOW_OVERLAP = "INPUT_WINDOW_OVERLAP"
+    IN_ATTRIBUTES = "INPUT_ATTRIBUTES"
+    OUT_EDGES = 'OUTPUT_EDGES'
+    OUT_POINTS = 'OUTPUT_POINTS'
+
+    def __init__(self):
+        super(ValhallaTraceAttributesCarAlgo, self).__init__()
+        self.providers = configmanager.read_config()['providers']
+        self.costing_options = self.COSTING()
+
+    def initAlgorithm(self, configuration, p_str=None, Any=None, *args, **kwargs):
+
+        providers = [provider['name'] for provider in self.providers]
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.IN_PROVIDER,
+                "Provider",
+                providers,
+                defaultValue=providers[0]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                name=self.IN_TRACKS,
+                description="Input GPS track layer (Point or LineString)",
+                types=[QgsProcessing.TypeVectorPoint, QgsProcessing.TypeVectorLine],
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterField(
+                name=self.IN_TRACK_FIELD,
+                description="Track ID Field",
+                parentLayerParameterName=self.IN_TRACKS,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterField(
+                name=self.IN_ORDER_FIELD,
+                description="Point order field, e.g. timestamp (Point layers only, feature ID if empty)",
+                parentLayerParameterName=self.IN_TRACKS,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.IN_MODE,
+                'Mode',
+                options=self.MODE_TYPES,
+                defaultValue=self.MODE_TYPES[0]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.IN_SHAPE_MATCH,
+                'Shape matching',
+                options=self.SHAPE_MATCH_TYPES,
+                defaultValue=self.SHAPE_MATCH_TYPES[0]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.IN_ATTRIBUTES,
+                'Additional edge attributes',
+                options=self.ATTRIBUTE_TYPES,
+                allowMultiple=True,
+                optional=True
+            )
+        )
+
+        advanced = [
+            QgsProcessingParameterNumber(
+                name=self.IN_WINDOW_SIZE,
+                description="Maximum points per request, longer tracks are matched in overlapping windows",
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=2000,
+                minValue=10
+            ),
+            QgsProcessingParameterNumber(
+                name=self.IN_WINDOW_OVERLAP,
+                description="Points shared by consecutive windows",
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=50,
+                minValue=2
+            )
+        ]
+        advanced.extend(self.costing_options.get_costing_params())
+
+        for p in advanced:
+            p.setFlags(p.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+            self.addParameter(p)
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                name=self.OUT_EDGES,
+                description="Matched Edges " + self.PROFILE.capitalize(),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                name=self.OUT_POINTS,
+                description="Matched Points " + self.PROFILE.capitalize(),
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+    def group(self):
+        return self.PROFILE.capitalize()
+
+    def groupId(self):
+        return self.PROFILE
+
+    def name(self):
+        return self.ALGO_NAME
+
+    def shortHelpString(self):
+        """Displays the sidebar help in the algorithm window"""
+
+        file = os.path.join(
+            HELP_DIR,
+            self.HELP
+        )
+        with open(file) as helpf:
+            msg = helpf.read()
+
+        return msg
+
+    def helpUrl(self):
+        """will be connected to the Help button in the Algorithm window"""
+        return __help__
+
+    def displayName(self):
+        return " ".join(map(lambda x: x.capitalize(), self.ALGO_NAME_LIST))
+
+    def icon(self):
+        return QIcon(RESOURCE_PREFIX + 'icon_directions.png')
+
+    def createInstance(self):
+        return ValhallaTraceAttributesCarAlgo()
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        # Init client
+        providers = configmanager.read_config()['providers']
+        provider = providers[self.parameterAsEnum(parameters, self.IN_PROVIDER, context)]
+        clnt = client.get_client(provider)
+        clnt.warm_up()
+
+        provider_caps = capabilities.get_capabilities(clnt, provider)
+        if not provider_caps.has_action('/trace_attributes'):
+            raise QgsProcessingException(f"ProviderError: {provider['name']} doesn't offer /trace_attributes.")
+        max_shape = provider_caps.limit('trace', 'max_shape')
+
+        # Get parameter values
+        source = self.parameterAsSource(parameters, self.IN_TRACKS, context)
+        if source.wkbType() == QgsWkbTypes.MultiPoint:
+            raise QgsProcessingException("TypeError: Multipoint Layers are not accepted. Please convert to single geometry layer.")
+        track_field_name = self.parameterAsString(parameters, self.IN_TRACK_FIELD, context)
+        order_field_name = self.parameterAsString(parameters, self.IN_ORDER_FIELD, context)
+        mode = self.MODE_TYPES[self.parameterAsEnum(parameters, self.IN_MODE, context)]
+        shape_match = self.SHAPE_MATCH_TYPES[self.parameterAsEnum(parameters, self.IN_SHAPE_MATCH, context)]
+        window_size = self.parameterAsInt(parameters, self.IN_WINDOW_SIZE, context)
+        if max_shape:
+            window_size = min(window_size, max_shape)
+        window_overlap = self.parameterAsInt(parameters, self.IN_WINDOW_OVERLAP, context)
+        if window_overlap >= window_size // 2:
+            raise QgsProcessingException("ParameterError: The window overlap has to be less than half the window size.")
+
+        # Only the output attributes are requested
+        extra_attributes = [self.ATTRIBUTE_TYPES[idx] for idx in self.parameterAsEnums(parameters, self.IN_ATTRIBUTES, context)]
+        filters = trace_attributes_core.get_filters(extra_attributes)
+
+        # Sets all advanced parameters as attributes of self.costing_options
+        self.costing_options.set_costing_options(self, parameters, context)
+
+        track_field = source.fields().field(track_field_name)
+        (edge_sink, edges_id) = self.parameterAsSink(parameters, self.OUT_EDGES, context,
+                                                     trace_attributes_core.get_fields('edge', track_field, extra_attributes),
+                                                     QgsWkbTypes.LineString,
+                                                     QgsCoordinateReferenceSystem(4326))
+        (point_sink, points_id) = self.parameterAsSink(parameters, self.OUT_POINTS, context,
+                                                       trace_attributes_core.get_fields('point', track_field),
+                                                       QgsWkbTypes.Point,
+                                                       QgsCoordinateReferenceSystem(4326))
+        if edge_sink is None and point_sink is None:
+            raise QgsProcessingException("ParameterError: Please set at least one of the outputs.")
+        sinks = [batching.BatchedSink(sink) if sink is not None else None for sink in (edge_sink, point_sink)]
+
+        if QgsWkbTypes.geometryType(source.wkbType()) == QgsWkbTypes.PointGeometry:
+            track_count = len(source.uniqueValues(source.fields().lookupField(track_field_name)))
+        else:
+            track_count = source.featureCount()
+
+        def get_requests():
+            """
+            Builds the requests lazily, so only the tracks in flight are held in memory. Long tracks are split into
+            overlapping windows, which are requested like separate tracks.
+            """
+            for track_id, points in self._get_tracks(source, track_field_name, order_field_name):
+                if len(points) < 2:
+                    feedback.reportError(f"Track ID {track_id} has less than 2 points, skipping.")
+                    continue
+                windows = trace_attributes_core.get_windows(len(points), window_size, window_overlap)
+                for idx, (start, end, owned_start, owned_end) in enumerate(windows):
+                    params = get_trace_params(points[start:end], self.PROFILE, self.costing_options, mode, shape_match)
+                    params['id'] = track_id
+                    params['filters'] = filters
+
+                    yield params, (owned_start, owned_end), idx, len(windows)
+
+        num = 0
+        windows, failed = [], False
+        for (params, owned, idx, window_count), future in concurrency.ordered_map(partial(self._match, provider),
+                                                                                 get_requests()):
+            # Stop the algorithm if cancel button has been clicked
+            if feedback.isCanceled():
+                break
+
+            # Windows arrive in order, a new track starts with window 0
+            if idx == 0:
+                windows, failed = [], False
+
+            try:
+                response = future.result()
+            except (exceptions.ApiError,
+                    exceptions.Timeout,
+                    exceptions.OverQueryLimit,
+                    exceptions.GenericServerError) as e:
+                # An unreachable host fails every track
+                if isinstance(e, exceptions.GenericServerError) and e.status == 1:
+                    logger.log("{}:\n{}".format(e.__class__.__name__, str(e)), 2)
+                    raise
+                msg = "Track ID {} caused a {}:\n{}".format(
+                    params['id'],
+                    e.__class__.__name__,
+                    str(e))
+                if window_count > 1:
+                    msg += f"\nin window {idx + 1} of {window_count}, the track is skipped."
+                feedback.reportError(msg)
+                logger.log(msg, 1)
+                failed = True
+                continue
+
+            except exceptions.InvalidKey as e:
+                msg = "{}:\n{}".format(
+                    e.__class__.__name__,
+                    str(e))
+                logger.log(msg, 2)
+                raise
+
+            if failed:
+                continue
+            if window_count > 1:
+                windows.append((response, *owned))
+                if idx < window_count - 1:
+                    continue
+                output_features = trace_attributes_core.get_output_features(
+                    *trace_attributes_core.stitch_responses(windows),
+                    extra_attributes=extra_attributes
+                )
+                windows = []
+            else:
+                output_features = trace_attributes_core.get_output_features(
+                    response,
+                    extra_attributes=extra_attributes
+                )
+
+            for sink, feats in zip(sinks, output_features):
+                if sink is None:
+                    continue
+                for feat in feats:
+                    feat.setAttributes([params['id']] + feat.attributes())
+                sink.addFeatures(feats)
+
+            num += 1
+            feedback.setProgress(int(100.0 / track_count * num))
+
+        for sink in sinks:
+            if sink is not None:
+                sink.flush()
+
+        logger.flush()
+
+        return {self.OUT_EDGES: edges_id, self.OUT_POINTS: points_id}
+
+    @staticmethod
+    def _match(provider, request):
+        """
+        Map matches one track or window. Runs in a worker thread, which gets its own client.
+
+        :param provider: provider settings from config.yml
+        :type provider: dict
+
+        :param request: trace_attributes parameters and window properties, see get_requests()
+        :type request: tuple
+
+        :returns: trace_attributes response
+        :rtype: dict
+        """
+        return client.get_client(provider).request('/trace_attributes', post_json=request[0])
+
+    @staticmethod
+    def _get_tracks(layer, track_field_name, order_field_name):
+        """
+        Generator to yield the track ID and WGS84 points of each track. Point layers are ordered by track ID and
+        order field on the provider side and grouped into tracks, line layers yield one track per line part.
+
+        :param layer: source input layer
+        :type layer: QgsProcessingParameterFeatureSource
+
+        :param track_field_name: name of the track ID field
+        :type track_field_name: str
+
+        :param order_field_name: name of the field ordering the points of a track, can be empty
+        :type order_field_name: str
+        """
+        crs = layer.sourceCrs()
+
+        if QgsWkbTypes.geometryType(layer.wkbType()) == QgsWkbTypes.PointGeometry:
+            feats = features.get_features(
+                layer,
+                [track_field_name, order_field_name],
+                order_by=[track_field_name, order_field_name]
+            )
+            for track_id, group in groupby(feats, key=lambda f: f[track_field_name]):
+                yield track_id, transform.transform_points([feat.geometry().asPoint() for feat in group], crs)
+        else:
+            for feat in features.get_features(layer, [track_field_name]):
+                geom = feat.geometry()
+                # Every part of a multi-line is matched on its own, the parts aren't necessarily connected
+                lines = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+                for line in lines:
+                    yield feat[track_field_name], transform.transform_points(line, crs)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import os
+import unittest
+
+from ..common import trace_attributes_core
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'trace_attributes_response.json')
+
+
+class TestTraceAttributesCore(unittest.TestCase):
+
+    def setUp(self):
+        with open(FIXTURE, encoding='utf-8') as f:
+            self.response = json.load(f)
+
+    def test_edge_features(self):
+        extra = ['names', 'road_class']
+        edge_feats, _ = trace_attributes_core.get_output_features(self.response, extra_attributes=extra)
+        fields = trace_attributes_core.get_fields('edge', extra_attributes=extra)
+
+        self.assertEqual(len(edge_feats), 3)
+        self.assertEqual(len(edge_feats[0].attributes()), fields.count())
+        attributes = dict(zip(fields.names(), edge_feats[0].attributes()))
+        self.assertEqual(attributes['EDGE_ID'], 1238492118345)
+        self.assertEqual(attributes['OSM_ID'], 4045285)
+        self.assertEqual(attributes['SRC_PERC'], 0.41)
+        self.assertEqual(attributes['TARGET_PERC'], 1.0)
+        self.assertEqual(dict(zip(fields.names(), edge_feats[2].attributes()))['NAMES'], 'Dorotheenstraße, B 2')
+
+    def test_edge_geometries(self):
+        edge_feats, _ = trace_attributes_core.get_output_features(self.response)
+
+        # Consecutive edges share their end vertex
+        vertices = [feat.geometry().asPolyline() for feat in edge_feats]
+        self.assertEqual([len(v) for v in vertices], [2, 3, 3])
+        self.assertEqual(vertices[0][-1], vertices[1][0])
+        self.assertAlmostEqual(vertices[0][0].x(), 13.38886)
+        self.assertAlmostEqual(vertices[0][0].y(), 52.517037)
+
+    def test_point_features(self):
+        _, point_feats = trace_attributes_core.get_output_features(self.response)
+
+        self.assertEqual(len(point_feats), 4)
+        self.assertEqual(point_feats[1].attributes(), ['matched', 1, 0.43, 1.874])
+        # Unmatched points have no edge attributes
+        self.assertEqual(point_feats[2].attributes(), ['unmatched', 0, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
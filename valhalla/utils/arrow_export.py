@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+import os.path
+
+from PyQt5.QtCore import QVariant
+
+from qgis.core import QgsFeatureSink, QgsProcessingException
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Extensions which are written as Arrow IPC files, everything else is written as GeoParquet
+IPC_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+FILE_FILTER = 'GeoParquet (*.parquet);;Arrow IPC (*.arrow *.feather)'
+
+DEFAULT_BATCH_SIZE = 10000
+GEOMETRY_COLUMN = 'geometry'
+
+
+def _arrow_type(field):
+    """
+    Maps a QGIS field to the Arrow column type.
+
+    :param field: field of the output layer
+    :type field: QgsField
+
+    :rtype: pyarrow.DataType
+    """
+    field_type = field.type()
+    if field_type in (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong):
+        return pa.int64()
+    if field_type == QVariant.Double:
+        return pa.float64()
+    if field_type == QVariant.Bool:
+        return pa.bool_()
+
+    return pa.string()
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, QVariant) and value.isNull())
+
+
+class ArrowSink(object):
+    """
+    Feature sink writing Arrow record batches to a GeoParquet or Arrow IPC file. Features are buffered column-wise
+    and written every batch_size features, geometries are stored as WKB.
+
+    Mirrors the addFeature(s) interface of QgsFeatureSink, so it can be used in place of a processing sink.
+    close() has to be called in any case, also if the algorithm fails, otherwise the file stays open and incomplete.
+    The sink can be used as a context manager to do so.
+    """
+
+    def __init__(self, path, fields, geometry=True, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        :param path: output file path, .arrow/.feather write Arrow IPC, everything else GeoParquet.
+        :type path: str
+
+        :param fields: attribute fields of the output features
+        :type fields: QgsFields
+
+        :param geometry: whether to write a WKB geometry column
+        :type geometry: bool
+
+        :param batch_size: number of features per record batch
+        :type batch_size: int
+        """
+        if pa is None:
+            raise QgsProcessingException(
+                "ImportError: Writing Arrow/GeoParquet files needs the 'pyarrow' package in the QGIS Python environment."
+            )
+
+        self.path = path
+        self.geometry = geometry
+        self.batch_size = batch_size
+
+        self.names = fields.names()
+        self.types = [_arrow_type(field) for field in fields]
+        arrow_fields = [pa.field(name, arrow_type) for name, arrow_type in zip(self.names, self.types)]
+
+        metadata = None
+        if geometry:
+            arrow_fields.append(pa.field(GEOMETRY_COLUMN, pa.binary()))
+            # All outputs are lon/lat, which is the GeoParquet default CRS (OGC:CRS84)
+            metadata = {b'geo': json.dumps({
+                "version": "1.0.0",
+                "primary_column": GEOMETRY_COLUMN,
+                "columns": {GEOMETRY_COLUMN: {"encoding": "WKB", "geometry_types": []}}
+            }).encode()}
+        self.schema = pa.schema(arrow_fields, metadata=metadata)
+
+        if os.path.splitext(path)[1].lower() in IPC_EXTENSIONS:
+            self._writer = pa.ipc.new_file(path, self.schema)
+        else:
+            self._writer = pq.ParquetWriter(path, self.schema)
+
+        self._columns = [[] for _ in self.schema]
+
+    def addFeature(self, feature, flags=QgsFeatureSink.Flags()):
+        """
+        Buffers a feature and writes a record batch once batch_size features are buffered.
+
+        :param feature: output feature with attributes in the order of fields
+        :type feature: QgsFeature
+
+        :rtype: bool
+        """
+        for column, value in zip(self._columns, feature.attributes()):
+            column.append(None if _is_null(value) else value)
+        if self.geometry:
+            geom = feature.geometry()
+            self._columns[-1].append(None if geom.isNull() else bytes(geom.asWkb()))
+
+        if len(self._columns[0]) >= self.batch_size:
+            self.flush()
+
+        return True
+
+    def addFeatures(self, features, flags=QgsFeatureSink.Flags()):
+        for feature in features:
+            self.addFeature(feature, flags)
+
+        return True
+
+    def flush(self):
+        """Writes the buffered features as one record batch."""
+        if not self._columns[0]:
+            return
+        arrays = []
+        for column, arrow_field in zip(self._columns, self.schema):
+            if arrow_field.type == pa.string():
+                column = [value if value is None else str(value) for value in column]
+            arrays.append(pa.array(column, type=arrow_field.type))
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self._columns = [[] for _ in self.schema]
+
+    def close(self):
+        """Writes the remaining features and finalizes the file. Does nothing if the sink is already closed."""
+        if self._writer is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SinkGroup(object):
+    """Forwards features to several sinks, e.g. a processing sink and an ArrowSink."""
+
+    def __init__(self, *sinks):
+        self.sinks = [sink for sink in sinks if sink is not None]
+
+    def addFeature(self, feature, flags=QgsFeatureSink.Flags()):
+        return all([sink.addFeature(feature, flags) for sink in self.sinks])
+
+    def addFeatures(self, features, flags=QgsFeatureSink.Flags()):
+        features = list(features)
+        return all([sink.addFeatures(features, flags) for sink in self.sinks])
+
+
+def get_sink(path, fields, sink=None, geometry=True):
+    """
+    Opens an ArrowSink if path is set and combines it with the processing sink.
+
+    :param path: Arrow/GeoParquet output path, can be empty.
+    :type path: str
+
+    :param fields: attribute fields of the output features
+    :type fields: QgsFields
+
+    :param sink: processing sink, can be None.
+    :type sink: QgsFeatureSink
+
+    :param geometry: whether to write a WKB geometry column
+    :type geometry: bool
+
+    :returns: the sink to add features to, None if neither output is set, and the ArrowSink to close when done.
+    :rtype: tuple of (SinkGroup, ArrowSink)
+    """
+    arrow_sink = ArrowSink(path, fields, geometry) if path else None
+    if sink is None and arrow_sink is None:
+        return None, None
+
+    return SinkGroup(sink, arrow_sink), arrow_sink
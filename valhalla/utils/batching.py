@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import QgsFeatureSink
+
+from . import configmanager
+
+# Default if config.yml has no "processing" section
+DEFAULT_BATCH_SIZE = 1000
+
+
+def get_batch_size():
+    """
+    Reads the number of features per sink write from the "processing" section of config.yml.
+
+    :rtype: int
+    """
+    settings = configmanager.read_config().get('processing') or {}
+
+    return max(int(settings.get('batch_size', DEFAULT_BATCH_SIZE)), 1)
+
+
+class BatchedSink(object):
+    """
+    Collects features and writes them to the wrapped sink in batches with QgsFeatureSink.FastInsert, instead of
+    one addFeature() call per feature. Works for processing sinks and vector data providers alike.
+
+    flush() has to be called once all features are added.
+    """
+
+    def __init__(self, sink, batch_size=None):
+        """
+        :param sink: sink to write to
+        :type sink: QgsFeatureSink
+
+        :param batch_size: number of features per write, read from config.yml if None
+        :type batch_size: int
+        """
+        self.sink = sink
+        self.batch_size = batch_size or get_batch_size()
+        self._features = []
+
+    def addFeature(self, feature, flags=QgsFeatureSink.Flags()):
+        self._features.append(feature)
+        if len(self._features) >= self.batch_size:
+            return self.flush()
+
+        return True
+
+    def addFeatures(self, features, flags=QgsFeatureSink.Flags()):
+        self._features.extend(features)
+        if len(self._features) >= self.batch_size:
+            return self.flush()
+
+        return True
+
+    def flush(self):
+        """Writes all collected features to the wrapped sink."""
+        if not self._features:
+            return True
+        features, self._features = self._features, []
+        result = self.sink.addFeatures(features, QgsFeatureSink.FastInsert)
+        # Data providers return (success, features)
+        if isinstance(result, tuple):
+            result = result[0]
+
+        return result
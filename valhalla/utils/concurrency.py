@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import configmanager
+
+# Default if config.yml has no "processing" section
+DEFAULT_MAX_WORKERS = 4
+
+
+def get_max_workers():
+    """
+    Reads the number of concurrent requests from the "processing" section of config.yml.
+
+    :rtype: int
+    """
+    settings = configmanager.read_config().get('processing') or {}
+
+    return max(int(settings.get('max_workers', DEFAULT_MAX_WORKERS)), 1)
+
+
+def ordered_map(func, iterable, max_workers=None):
+    """
+    Generator which runs func for every item of iterable in a thread pool and yields the futures in input order.
+    Only a few items are submitted ahead of the consumer, so iterable can be a lazy stream of large inputs.
+
+    Each worker thread gets its own client from client.get_client(), so func should fetch it there.
+    Stopping the iteration cancels the pending items.
+
+    :param func: called with one item of iterable
+    :type func: callable
+
+    :param iterable: function arguments
+    :type iterable: iterable
+
+    :param max_workers: number of threads, read from config.yml if None
+    :type max_workers: int
+
+    :returns: item and its future
+    :rtype: tuple of (any, concurrent.futures.Future)
+    """
+    max_workers = max_workers or get_max_workers()
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -64,3 +64,39 @@ def decode_polyline6(expression, precision=6, is3d=False):
             coordinates.append((lat / factor, lng / factor, z / 100))
 
     return coordinates
+
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else (value << 1)
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+    return ''.join(chunks)
+
+
+def encode_polyline6(coordinates, precision=6):
+    """
+    Encodes (lat, lon) coordinates to an encoded polyline, the inverse of decode_polyline6().
+
+    :param coordinates: (lat, lon) pairs
+    :type coordinates: list of tuple
+
+    :param precision: number of decimals to keep
+    :type precision: int
+
+    :returns: encoded polyline
+    :rtype: str
+    """
+    factor = 10 ** precision
+    chunks, prev_lat, prev_lng = [], 0, 0
+
+    for lat, lng in coordinates:
+        lat, lng = int(round(lat * factor)), int(round(lng * factor))
+        chunks.append(_encode_value(lat - prev_lat))
+        chunks.append(_encode_value(lng - prev_lng))
+        prev_lat, prev_lng = lat, lng
+
+    return ''.join(chunks)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import numpy as np
+
+# Earth radius Valhalla uses for its distance limit checks (midgard's kRadEarthMeters)
+EARTH_RADIUS = 6378160.187
+
+
+def _to_radians(points):
+    """
+    Converts WGS84 points to an (n, 2) array of lon/lat radians.
+
+    :param points: WGS84 points or an (n, 2) array of lon/lat degrees.
+    :type points: list of QgsPointXY or numpy.ndarray
+
+    :rtype: numpy.ndarray
+    """
+    if not isinstance(points, np.ndarray):
+        points = np.array([(point.x(), point.y()) for point in points], dtype=float)
+
+    return np.radians(points.reshape(-1, 2))
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    """Great-circle distance in meters for broadcastable radian arrays."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def haversine_matrix(sources, targets):
+    """
+    Computes the great-circle distances between all sources and all targets in one go.
+
+    :param sources: WGS84 source points or an (n, 2) array of lon/lat degrees.
+    :type sources: list of QgsPointXY or numpy.ndarray
+
+    :param targets: WGS84 target points or an (m, 2) array of lon/lat degrees.
+    :type targets: list of QgsPointXY or numpy.ndarray
+
+    :returns: distances in meters with sources as rows and targets as columns.
+    :rtype: numpy.ndarray
+    """
+    src = _to_radians(sources)
+    tgt = _to_radians(targets)
+
+    return _haversine(src[:, 0, None], src[:, 1, None], tgt[None, :, 0], tgt[None, :, 1])
+
+
+def haversine_pairwise(sources, targets):
+    """
+    Computes the great-circle distances between the i-th source and the i-th target.
+
+    :param sources: WGS84 source points or an (n, 2) array of lon/lat degrees.
+    :type sources: list of QgsPointXY or numpy.ndarray
+
+    :param targets: WGS84 target points or an (n, 2) array of lon/lat degrees.
+    :type targets: list of QgsPointXY or numpy.ndarray
+
+    :returns: distances in meters
+    :rtype: numpy.ndarray
+    """
+    src = _to_radians(sources)
+    tgt = _to_radians(targets)
+    n = min(len(src), len(tgt))
+
+    return _haversine(src[:n, 0], src[:n, 1], tgt[:n, 0], tgt[:n, 1])
+
+
+def grid_cells(points, cell_size):
+    """
+    Assigns WGS84 points to the cells of a grid with cells of roughly cell_size by cell_size meters, so points
+    in the same cell can be treated as one location.
+
+    :param points: WGS84 points or an (n, 2) array of lon/lat degrees.
+    :type points: list of QgsPointXY or numpy.ndarray
+
+    :param cell_size: cell width and height in meters
+    :type cell_size: float
+
+    :returns: (row, column) of each point's cell
+    :rtype: list of tuple
+    """
+    coords = _to_radians(points)
+    lat_step = cell_size / EARTH_RADIUS
+    rows = np.floor(coords[:, 1] / lat_step)
+    # Columns get wider in degrees towards the poles to keep their width in meters
+    lon_step = lat_step / np.maximum(np.cos((rows + 0.5) * lat_step), 1e-6)
+    cols = np.floor(coords[:, 0] / lon_step)
+
+    return list(zip(rows.astype(int).tolist(), cols.astype(int).tolist()))
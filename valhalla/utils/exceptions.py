@@ -26,9 +26,11 @@
 
 class ApiError(Exception):
     """Represents an exception returned by the remote API."""
-    def __init__(self, status, message=None):
+    def __init__(self, status, message=None, error_code=None):
         self.status = status
         self.message = message
+        # Valhalla's own error code from the response body, e.g. 171, if it sent one
+        self.error_code = error_code
 
     def __str__(self):
         if self.message is None:
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import QgsExpression, QgsFeatureRequest
+
+
+def get_request(fields, field_names=(), sort=True, order_by=()):
+    """
+    Builds a feature request which only fetches the given attributes plus geometry. Optionally orders by fields and
+    feature ID, which the provider does on its side where it can.
+
+    :param fields: fields of the input layer
+    :type fields: QgsFields
+
+    :param field_names: names of the attributes to fetch, all others are NULL
+    :type field_names: list of str
+
+    :param sort: order features by feature ID
+    :type sort: bool
+
+    :param order_by: names of fields to order by before the feature ID
+    :type order_by: list of str
+
+    :rtype: QgsFeatureRequest
+    """
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes([name for name in field_names if name], fields)
+    for name in order_by:
+        if name:
+            request.addOrderBy(QgsExpression.quotedColumnRef(name))
+    if sort:
+        request.addOrderBy('$id')
+
+    return request
+
+
+def get_features(layer, field_names=(), sort=True, order_by=()):
+    """
+    Iterates over the features of an input layer, fetching only the given attributes plus geometry.
+    Careful: feat.id() is not necessarily permanent
+
+    :param layer: source input layer
+    :type layer: QgsProcessingFeatureSource or QgsVectorLayer
+
+    :param field_names: names of the attributes to fetch
+    :type field_names: list of str
+
+    :param sort: order features by feature ID
+    :type sort: bool
+
+    :param order_by: names of fields to order by before the feature ID
+    :type order_by: list of str
+
+    :rtype: QgsFeatureIterator
+    """
+    return layer.getFeatures(get_request(layer.fields(), field_names, sort, order_by))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import hashlib
+import json
+
+from qgis.core import QgsFeature
+
+from . import features, transform
+
+# Outputs name it 'fingerprint' or 'FINGERPRINT', field lookup is case-insensitive
+FIELD_NAME = 'fingerprint'
+# Request parameters which are part of the fingerprint's location/ID part, not of the costing hash
+_LOCATION_PARAMS = ('locations', 'id')
+
+
+def get_params_hash(params, base_url=''):
+    """
+    Hashes everything in a request which isn't tied to the input feature: costing, options, contours, avoid
+    locations and the server it's sent to.
+
+    :param params: request parameters
+    :type params: dict
+
+    :param base_url: the provider's base URL
+    :type base_url: str
+
+    :rtype: str
+    """
+    costing = {key: value for key, value in params.items() if key not in _LOCATION_PARAMS}
+    payload = json.dumps([base_url, costing], sort_keys=True, default=str)
+
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def get_fingerprint(points, id_values, params_hash):
+    """
+    Fingerprint of one result: the input locations, the input ID values and the hash from get_params_hash().
+
+    :param points: WGS84 input locations, before any snapping
+    :type points: list of QgsPointXY
+
+    :param id_values: ID field values of the input feature(s)
+    :type id_values: list
+
+    :param params_hash: hash of the remaining request parameters
+    :type params_hash: str
+
+    :rtype: str
+    """
+    coords = [[round(point.x(), 6), round(point.y(), 6)] for point in points]
+    payload = json.dumps([coords, [str(value) for value in id_values], params_hash])
+
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def get_previous_features(layer):
+    """
+    Reads a previous output layer into fingerprint -> features, with geometries in WGS84.
+
+    :param layer: output of an earlier run of the same algorithm
+    :type layer: QgsProcessingFeatureSource or QgsVectorLayer
+
+    :returns: features by fingerprint, None if the layer has no fingerprint field
+    :rtype: dict
+    """
+    field_idx = layer.fields().lookupField(FIELD_NAME)
+    if field_idx == -1:
+        return None
+
+    previous = dict()
+    crs = layer.sourceCrs()
+    for feat in features.get_features(layer, [field.name() for field in layer.fields()], sort=True):
+        geometry = feat.geometry()
+        feat.setGeometry(transform.transform_geometry(geometry, crs))
+        previous.setdefault(feat.attribute(field_idx), []).append(feat)
+
+    return previous
+
+
+def copy_features(previous_features, fields):
+    """
+    Copies previous results forward into the fields of the current output, matching attributes by name.
+
+    :param previous_features: features from get_previous_features()
+    :type previous_features: list of QgsFeature
+
+    :param fields: fields of the current output
+    :type fields: QgsFields
+
+    :returns: output features
+    :rtype: list of QgsFeature
+    """
+    copies = []
+    for previous in previous_features:
+        indices = [previous.fields().lookupField(field.name()) for field in fields]
+        feat = QgsFeature(fields)
+        feat.setGeometry(previous.geometry())
+        feat.setAttributes([previous.attribute(idx) if idx != -1 else None for idx in indices])
+        copies.append(feat)
+
+    return copies
@@ -24,27 +24,153 @@
  ***************************************************************************/
 """
 
+
+import threading
+
 from qgis.core import QgsMessageLog, Qgis
 
 from .. import PLUGIN_NAME
+from . import configmanager
+
+_LEVELS = {
+    0: Qgis.Info,
+    1: Qgis.Warning,
+    2: Qgis.Critical
+}
 
-def log(message, level_in=0):
+# Defaults if config.yml has no "logging" section
+_DEFAULT_LEVEL = 1
+_DEFAULT_BUFFER_SIZE = 100
+
+
+class _BufferedHandler:
+    """
+    Bounded message buffer which flushes to QgsMessageLog in batches. Every flush writes at most one
+    log entry per level, so a batch run doesn't flood the message log panel with one entry per request.
     """
-    Writes to QGIS inbuilt logger accessible through panel.
 
-    :param message: logging message to write, error or URL.
+    def __init__(self, min_level=_DEFAULT_LEVEL, buffer_size=_DEFAULT_BUFFER_SIZE):
+        """
+        :param min_level: minimum integer level which will be logged at all.
+        :type min_level: int
+
+        :param buffer_size: amount of messages held back before they're flushed.
+        :type buffer_size: int
+        """
+        self.min_level = min_level
+        self.buffer_size = max(1, buffer_size)
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def emit(self, message, level_in):
+        """
+        Buffers the message and flushes if the buffer is full. Warnings and errors are flushed immediately,
+        together with everything buffered before them to keep the order.
+
+        :param message: formatted message
+        :type message: str
+
+        :param level_in: integer representation of logging level.
+        :type level_in: int
+        """
+        with self._lock:
+            self._buffer.append((level_in, message))
+            if len(self._buffer) < self.buffer_size and level_in < 1:
+                return
+            batch, self._buffer = self._buffer, []
+
+        self._write(batch)
+
+    def flush(self):
+        """Writes all buffered messages to QgsMessageLog."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+
+        self._write(batch)
+
+    @staticmethod
+    def _write(batch):
+        """Joins consecutive messages of the same level into a single QgsMessageLog entry."""
+        chunk, chunk_level = [], None
+        for level_in, message in batch + [(None, None)]:
+            if level_in != chunk_level and chunk:
+                QgsMessageLog.logMessage("\n".join(chunk), PLUGIN_NAME.strip(), _LEVELS.get(chunk_level, Qgis.Info))
+                chunk = []
+            chunk_level = level_in
+            chunk.append(message)
+
+
+_handler = None
+
+
+def _get_handler():
+    """Lazily builds the handler from the "logging" section of config.yml."""
+    global _handler
+    if _handler is None:
+        configure()
+
+    return _handler
+
+
+def configure(settings=None):
+    """
+    (Re-)Configures log level and buffer size. Already buffered messages are flushed first.
+
+    :param settings: logging settings, e.g. {'level': 1, 'buffer_size': 100}. Read from config.yml if None.
+    :type settings: dict
+    """
+    global _handler
+    if settings is None:
+        settings = configmanager.read_config().get('logging') or {}
+
+    if _handler is not None:
+        _handler.flush()
+
+    _handler = _BufferedHandler(
+        settings.get('level', _DEFAULT_LEVEL),
+        settings.get('buffer_size', _DEFAULT_BUFFER_SIZE)
+    )
+
+
+def is_enabled(level_in=0):
+    """
+    Whether a message of this level would be logged. Use to guard expensive message arguments.
+
+    :param level_in: integer representation of logging level.
+    :type level_in: int
+
+    :rtype: bool
+    """
+    return level_in >= _get_handler().min_level
+
+
+def log(message, level_in=0, *args):
+    """
+    Writes to QGIS inbuilt logger accessible through panel. Messages below the configured level are
+    discarded before formatting, so pass format arguments separately, e.g. log("url: {}", 0, url).
+
+    :param message: logging message to write, error or URL. Can contain str.format() placeholders.
     :type message: str
 
     :param level_in: integer representation of logging level.
     :type level_in: int
+
+    :param args: arguments to format the message with, only if the level is enabled.
+    :type args: any
     """
-    if level_in == 0:
-        level = Qgis.Info
-    elif level_in == 1:
-        level = Qgis.Warning
-    elif level_in == 2:
-        level = Qgis.Critical
-    else:
-        level = Qgis.Info
+    if level_in not in _LEVELS:
+        level_in = 0
+
+    handler = _get_handler()
+    if level_in < handler.min_level:
+        return
+
+    if args:
+        message = message.format(*args)
+
+    handler.emit(message, level_in)
+
 
-    QgsMessageLog.logMessage(message, PLUGIN_NAME.strip(), level)
\ No newline at end of file
+def flush():
+    """Writes all buffered messages to the QGIS message log, e.g. at the end of an algorithm run."""
+    _get_handler().flush()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 Valhalla - QGIS plugin
+ QGIS client to query Valhalla APIs
+                              -------------------
+        begin                : 2019-10-12
+        git sha              : $Format:%H$
+        copyright            : (C) 2020 by Nils Nolde
+        email                : nils@gis-ops.com
+ ***************************************************************************/
+
+ This plugin provides access to some of the APIs from Valhalla
+ (https://github.com/valhalla/valhalla), developed and
+ maintained by https://gis-ops.com, Berlin, Germany.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+import os
+import re
+import shlex
+import sqlite3
+import subprocess
+from contextlib import closing
+
+INDEX_SUFFIX = '.waytags.sqlite'
+# Ways per INSERT and ids per SELECT
+CHUNK_SIZE = 10000
+QUERY_CHUNK_SIZE = 500
+
+_ESCAPED = re.compile(r'%([0-9a-fA-F]+)%')
+
+
+def _unescape(value):
+    """Decodes OPL escapes, e.g. '%20%' for a space."""
+    return _ESCAPED.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+
+def parse_opl_way(line):
+    """
+    Parses a way from a line of osmium's OPL output.
+
+    :param line: OPL line, e.g. 'w42 v1 dV c1 t2020-01-01T00:00:00Z i1 uuser Thighway=primary,name=Main%20%Street Nn1,n2'
+    :type line: str
+
+    :returns: way ID and tags in 'key=value' format
+    :rtype: tuple of (int, list of str)
+    """
+    fields = line.rstrip('\n').split(' ')
+    tags = list()
+    for field in fields[1:]:
+        # '=' and ',' within keys and values are escaped
+        if field.startswith('T') and len(field) > 1:
+            for tag in field[1:].split(','):
+                key, value = tag.split('=', 1)
+                tags.append(_unescape(key) + '=' + _unescape(value))
+
+    return int(fields[0][1:]), tags
+
+
+def iter_osmium_ways(cmd):
+    """
+    Generator to stream the ways of an osmium command writing OPL to stdout, one line at a time.
+
+    :param cmd: osmium command with '-f opl -o -'
+    :type cmd: str
+
+    :returns: way ID and tags in 'key=value' format
+    :rtype: tuple of (int, list of str)
+    """
+    with subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, universal_newlines=True,
+                          encoding='utf-8') as proc:
+        for line in proc.stdout:
+            if line.startswith('w'):
+                yield parse_opl_way(line)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+class WayTagIndex(object):
+    """
+    Persistent way ID -> tags index of a PBF file, stored in SQLite next to the PBF. It is built once with osmium and
+    rebuilt when the PBF's modification time or size changes.
+    """
+
+    def __init__(self, pbf_path):
+        """
+        :param pbf_path: path to the OSM PBF file
+        :type pbf_path: str
+        """
+        self.pbf_path = pbf_path
+        self.index_path = pbf_path + INDEX_SUFFIX
+
+    def _pbf_signature(self):
+        stat = os.stat(self.pbf_path)
+
+        return str(stat.st_mtime_ns), str(stat.st_size)
+
+    def is_current(self):
+        """
+        :returns: whether the index exists and was built from the current PBF file.
+        :rtype: bool
+        """
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with closing(sqlite3.connect(self.index_path)) as conn:
+                meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        except sqlite3.Error:
+            return False
+
+        return (meta.get('mtime'), meta.get('size')) == self._pbf_signature()
+
+    def build(self):
+        """
+        Streams all ways of the PBF from osmium into a new index, which replaces the old one when complete.
+        """
+        mtime, size = self._pbf_signature()
+        tmp_path = self.index_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        cmd = f"osmium cat -t way -f opl --no-progress -o - {shlex.quote(self.pbf_path)}"
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute("CREATE TABLE ways (way_id INTEGER PRIMARY KEY, tags TEXT)")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            rows = list()
+            for way_id, tags in iter_osmium_ways(cmd):
+                rows.append((way_id, json.dumps(tags)))
+                if len(rows) >= CHUNK_SIZE:
+                    conn.executemany("INSERT OR REPLACE INTO ways VALUES (?, ?)", rows)
+                    rows = list()
+            conn.executemany("INSERT OR REPLACE INTO ways VALUES (?, ?)", rows)
+
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [('mtime', mtime), ('size', size)])
+            conn.commit()
+        except BaseException:
+            conn.close()
+            os.remove(tmp_path)
+            raise
+        conn.close()
+
+        os.replace(tmp_path, self.index_path)
+
+    def get_tags(self, way_ids):
+        """
+        Looks up the tags of ways.
+
+        :param way_ids: OSM way IDs
+        :type way_ids: list of int
+
+        :returns: tags in 'key=value' format by way ID, ways missing from the PBF are left out.
+        :rtype: dict
+        """
+        tags = dict()
+        with closing(sqlite3.connect(self.index_path)) as conn:
+            for i in range(0, len(way_ids), QUERY_CHUNK_SIZE):
+                chunk = way_ids[i:i + QUERY_CHUNK_SIZE]
+                rows = conn.execute(
+                    "SELECT way_id, tags FROM ways WHERE way_id IN ({})".format(','.join('?' * len(chunk))),
+                    chunk
+                )
+                for way_id, way_tags in rows:
+                    tags[way_id] = json.loads(way_tags)
+
+        return tags
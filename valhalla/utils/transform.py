@@ -24,15 +24,53 @@
  ***************************************************************************/
 """
 
+import threading
+
 from qgis.core import (QgsCoordinateReferenceSystem,
                        QgsCoordinateTransform,
+                       QgsLineString,
+                       QgsPointXY,
                        QgsProject
                        )
 
+WGS84 = 'EPSG:4326'
+
+# Transformers by source CRS in thread-local storage, see transformToWGS()
+_LOCAL = threading.local()
+# Caches hold at most this many transformers
+_MAX_TRANSFORMERS = 32
+# Bumped whenever the project's transform context may have changed, which invalidates all caches
+_generation = 0
+
+
+def _invalidate():
+    global _generation
+    _generation += 1
+
+
+QgsProject.instance().transformContextChanged.connect(_invalidate)
+QgsProject.instance().cleared.connect(_invalidate)
+
+
+def _crs_key(crs):
+    return crs.authid() or crs.toWkt()
+
+
+def is_wgs84(crs):
+    """
+    :param crs: CRS to check
+    :type crs: QgsCoordinateReferenceSystem
+
+    :returns: whether coordinates in crs can be sent to Valhalla as they are.
+    :rtype: bool
+    """
+    return crs.authid() == WGS84
+
 
 def transformToWGS(old_crs):
     """
-    Returns a transformer to WGS84
+    Returns a transformer to WGS84. Transformers are cached per source CRS in thread-local storage, until the
+    project's transform context changes.
 
     :param old_crs: CRS to transfrom from
     :type old_crs: QgsCoordinateReferenceSystem
@@ -40,7 +78,80 @@ def transformToWGS(old_crs):
     :returns: transformer to use in various modules.
     :rtype: QgsCoordinateTransform
     """
-    outCrs = QgsCoordinateReferenceSystem('EPSG:4326')
-    xformer = QgsCoordinateTransform(old_crs, outCrs, QgsProject.instance())
+    if getattr(_LOCAL, 'generation', None) != _generation:
+        _LOCAL.transformers = dict()
+        _LOCAL.generation = _generation
+
+    key = _crs_key(old_crs)
+    xformer = _LOCAL.transformers.get(key)
+    if xformer is None:
+        if len(_LOCAL.transformers) >= _MAX_TRANSFORMERS:
+            _LOCAL.transformers.clear()
+        outCrs = QgsCoordinateReferenceSystem(WGS84)
+        xformer = QgsCoordinateTransform(old_crs, outCrs, QgsProject.instance())
+        _LOCAL.transformers[key] = xformer
 
     return xformer
+
+
+def transform_coords(xs, ys, old_crs):
+    """
+    Transforms coordinate arrays to WGS84 in one call. Returns the input if old_crs already is WGS84.
+
+    :param xs: x coordinates
+    :type xs: list of float
+
+    :param ys: y coordinates
+    :type ys: list of float
+
+    :param old_crs: CRS to transform from
+    :type old_crs: QgsCoordinateReferenceSystem
+
+    :returns: transformed x and y coordinates
+    :rtype: tuple of (list of float, list of float)
+    """
+    if is_wgs84(old_crs) or not len(xs):
+        return list(xs), list(ys)
+
+    # The vertices of a line string are transformed in bulk on the C++ side
+    line = QgsLineString(list(xs), list(ys))
+    line.transform(transformToWGS(old_crs))
+
+    return line.xVector(), line.yVector()
+
+
+def transform_points(points, old_crs):
+    """
+    Transforms points to WGS84 in one call.
+
+    :param points: points to transform
+    :type points: list of QgsPointXY or QgsPoint
+
+    :param old_crs: CRS to transform from
+    :type old_crs: QgsCoordinateReferenceSystem
+
+    :returns: transformed points
+    :rtype: list of QgsPointXY
+    """
+    xs, ys = transform_coords([point.x() for point in points], [point.y() for point in points], old_crs)
+
+    return [QgsPointXY(x, y) for x, y in zip(xs, ys)]
+
+
+def transform_geometry(geom, old_crs):
+    """
+    Transforms a geometry to WGS84 in place, unless old_crs already is WGS84.
+
+    :param geom: geometry to transform
+    :type geom: QgsGeometry
+
+    :param old_crs: CRS to transform from
+    :type old_crs: QgsCoordinateReferenceSystem
+
+    :returns: the transformed geometry
+    :rtype: QgsGeometry
+    """
+    if not is_wgs84(old_crs):
+        geom.transform(transformToWGS(old_crs))
+
+    return geom